@@ -14,6 +14,10 @@ WORKER_NAME = 'worker'
 CONTROL_LIFECYCLE_ENABLED = True
 SERIALIZER_CLASS = 'metropolis.core.serializer.JsonMessageSerializer'
 
+# locality settings (same node/zone replicas are preferred)
+NODE_NAME = env.get('NODE_NAME')
+ZONE_NAME = env.get('ZONE_NAME')
+
 # worker settings
 HEARTBEAT_INTERVAL = 5
 
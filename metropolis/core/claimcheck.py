@@ -0,0 +1,144 @@
+import fcntl
+import logging
+import mmap
+import os
+import time
+import uuid
+
+
+# payload prefix of claim references, serialized messages never start with NUL
+CLAIM_PREFIX = b'\x00claim:'
+
+# payload prefix of small payloads of claim-check enabled senders
+INLINE_PREFIX = b'\x00inline:'
+
+# header of claim file holding reference count
+REFS_SIZE = 8
+
+
+class ClaimCheckError(Exception):
+    pass
+
+
+class ClaimCheckStore(object):
+    """Claim-check payload store for co-located processes
+
+    Payloads larger than `threshold` are written to a memory backed spill
+    directory (e.g. `/dev/shm`) shared by processes of the same host, and
+    only the reference `{CLAIM_PREFIX}{host} {name}` travels over nats.
+    Smaller ones travel as `{INLINE_PREFIX}{host} {payload}`, so receivers
+    know the sender host in both cases.
+
+    Claim files start with a reference count, each check out decrements it
+    under file lock and the last one removes the file. Claims which are
+    never checked out are removed after `ttl` seconds.
+    """
+
+    def __init__(self, directory, host, threshold, ttl):
+        self.directory = directory
+        self.host = host
+        self.threshold = threshold
+        self.ttl = ttl
+
+        self._last_sweep = time.monotonic()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def check_in(self, payload, refs=1):
+        """Returns reference of the payload, inline payload if it is small
+        """
+
+        if len(payload) <= self.threshold:
+            return b''.join((INLINE_PREFIX, self.host.encode(), b' ', payload))
+
+        name = uuid.uuid4().hex
+        path = os.path.join(self.directory, name)
+
+        with open(path, 'wb') as f:
+            f.write(refs.to_bytes(REFS_SIZE, 'little', signed=True))
+            f.write(payload)
+
+        self._sweep_periodically()
+
+        return b''.join((CLAIM_PREFIX, self.host.encode(), b' ', name.encode()))
+
+    @staticmethod
+    def is_claim(data):
+        return data.startswith(CLAIM_PREFIX)
+
+    @staticmethod
+    def sender_host(data):
+        """Returns host of claim-check enabled sender, None if unknown
+        """
+
+        for prefix in (CLAIM_PREFIX, INLINE_PREFIX):
+            if data.startswith(prefix):
+                host, _, _ = data[len(prefix):].partition(b' ')
+                return host.decode()
+
+        return None
+
+    def check_out(self, data):
+        """Returns payload of the reference, data itself if not a reference
+        """
+
+        if data.startswith(INLINE_PREFIX):
+            _, _, payload = data[len(INLINE_PREFIX):].partition(b' ')
+            return payload
+
+        if not self.is_claim(data):
+            return data
+
+        host, _, name = data[len(CLAIM_PREFIX):].decode().partition(' ')
+        if host != self.host:
+            raise ClaimCheckError(f'Claim of another host [host={host}]')
+
+        path = os.path.join(self.directory, name)
+
+        try:
+            with open(path, 'r+b') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+
+                with mmap.mmap(f.fileno(), 0) as mapped:
+                    refs = int.from_bytes(mapped[:REFS_SIZE], 'little', signed=True) - 1
+                    payload = mapped[REFS_SIZE:]
+                    mapped[:REFS_SIZE] = refs.to_bytes(REFS_SIZE, 'little', signed=True)
+
+                if refs <= 0:
+                    os.unlink(path)
+
+        except FileNotFoundError:
+            raise ClaimCheckError(f'Claim is expired [name={name}]')
+
+        return payload
+
+    def release(self, data):
+        """Drop reference which will not be checked out by its receiver
+        """
+
+        if self.is_claim(data):
+            try:
+                self.check_out(data)
+            except ClaimCheckError:
+                pass
+
+    def _sweep_periodically(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.ttl:
+            return
+
+        self._last_sweep = now
+        self.sweep()
+
+    def sweep(self):
+        expires = time.time() - self.ttl
+
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < expires:
+                    os.unlink(entry.path)
+                    logging.debug(f'Claim is expired [name={entry.name}]')
+
+            except FileNotFoundError:
+                # checked out by another process in the meantime
+                continue
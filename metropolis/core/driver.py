@@ -1,25 +1,57 @@
+import asyncio
 import logging
 import time
 
 from nats.aio.client import Client
-
+from nats.aio.client import Msg
+
+from metropolis.core.claimcheck import ClaimCheckError
+from metropolis.core.claimcheck import ClaimCheckStore
+from metropolis.core.inbox import ReplyInbox
+from metropolis.core.pipeline import EnvelopeError
+from metropolis.core.pipeline import create_envelope
+from metropolis.core.pipeline import is_expired
+from metropolis.core.pipeline import next_envelope
+from metropolis.core.pipeline import open_envelope
+from metropolis.core.schema import ValidationError
 from metropolis.core.utils import InterruptBumper
 
 
 WORKER_STATE_CONNECTED = 'connected'
-WORKER_STATE_DISCONNECTED = 'connected'
+WORKER_STATE_DISCONNECTED = 'disconnected'
 WORKER_STATE_ERROR = 'error'
 WORKER_STATE_CLOSED = 'closed'
 
+# interval of logging drain progress (sec)
+DRAIN_PROGRESS_INTERVAL = 1
+
+DEFAULT_INBOX_MAX_PENDING = 10000
+
+# reply of replicas refusing message, so that caller can try another one
+OVERLOADED_RESPONSE = {'code': 503, 'data': 'overloaded'}
+
 
 class NatsDriver(object):
     nats = None
+    inbox = None
     serializer = None
     state = None
 
-    def __init__(self, urls, serializer):
+    # claim-check store for payloads of co-located peers
+    claims = None
+
+    _overloaded_response = None
+
+    def __init__(self, urls, serializer, inbox_max_pending=DEFAULT_INBOX_MAX_PENDING):
         self.urls = urls
         self.serializer = serializer
+        self.inbox_max_pending = inbox_max_pending
+
+        # eventloop tasks which are executing messages
+        self._pending = set()
+
+        # (subject, fn name, elapsed) of the slowest execution blocking loop
+        self._slowest_execution = None
 
     async def get_connection(self, loop):
         self.nats = Client()
@@ -34,10 +66,30 @@ class NatsDriver(object):
             reconnected_cb=self.get_reconnected_cb()
         )
 
+        self.inbox = ReplyInbox(self.nats, self.inbox_max_pending)
+        await self.inbox.start()
+
         self.state = WORKER_STATE_CONNECTED
 
         return self.nats
 
+    @property
+    def overloaded_response(self):
+        if self._overloaded_response is None:
+            self._overloaded_response = self.serializer.serialize(OVERLOADED_RESPONSE)
+
+        return self._overloaded_response
+
+    @property
+    def is_connected(self):
+        return self.nats is not None and self.nats.is_connected
+
+    async def request(self, subject, payload, timeout):
+        """Request through the multiplexed reply inbox of the connection
+        """
+
+        return await self.inbox.request(subject, payload, timeout)
+
     def get_error_cb(self):
         async def on_error(exception):
             self.state = WORKER_STATE_ERROR
@@ -66,7 +118,17 @@ class NatsDriver(object):
 
         return on_reconnected
 
-    async def execute(self, task_fn, msg):
+    async def execute(self, task_fn, msg, data=None, schema=None, stage=False):
+        """Execute task with message and reply the result
+
+        :Params
+            - task_fn: task function
+            - msg: nats message
+            - data: already deserialized message data if exists
+            - schema <TaskSchema>: binds message data to task args
+            - stage <bool>: message is a pipeline envelope of stage subject
+        """
+
         logging.info((
             'Received message. '
             f'[subject={msg.subject}][fn={task_fn.__name__}]'
@@ -74,22 +136,67 @@ class NatsDriver(object):
         ))
 
         now = time.perf_counter()
-        data = self.serializer.deserialize(msg.data)
 
-        try:
-            ret = task_fn(**data)
-            code = 200
+        # reply is claim-checked only for claim-check enabled requester of this host
+        claims_reply = bool(self.claims) and (
+            data is None and self.claims.sender_host(msg.data) == self.claims.host)
+
+        # unreadable message is replied instead of leaving caller to time out
+        error = None
+        if data is None:
+            try:
+                data = self.serializer.deserialize(self.check_out(msg.data))
 
-        except Exception as e:
-            ret = str(e)
-            code = 500
+            except (ClaimCheckError, ValueError) as e:
+                logging.warning(f'Invalid message [subject={msg.subject}][error={e}]')
+                error = f'Invalid message: {e}'
 
-        if msg.reply:
+        pipeline = None
+        if stage and error is None:
+            try:
+                pipeline, data = open_envelope(data)
+
+            except EnvelopeError as e:
+                logging.warning(f'Invalid pipeline envelope [subject={msg.subject}][error={e}]')
+                error = 'Invalid pipeline envelope'
+
+        if error is not None:
+            ret = error
+            code = 400
+
+        elif pipeline and is_expired(pipeline):
+            ret = 'Pipeline stage timeout'
+            code = 504
+
+        else:
+            try:
+                kwargs = schema.bind(data) if schema else data
+                ret = task_fn(**kwargs)
+                code = 200
+
+            except ValidationError as e:
+                ret = str(e)
+                code = 400
+
+            except Exception as e:
+                ret = str(e)
+                code = 500
+
+            self._record_execution(
+                msg.subject, task_fn.__name__, time.perf_counter() - now)
+
+        if pipeline:
+            await self.forward(pipeline, code, ret)
+
+        elif msg.reply:
             response_data = self.serializer.serialize({
                 'code': code,
                 'data': ret
             })
 
+            if claims_reply:
+                response_data = self.claims.check_in(response_data)
+
             await self.nats.publish(msg.reply, response_data)
 
         elapsed = (time.perf_counter() - now) * 1000
@@ -100,14 +207,162 @@ class NatsDriver(object):
             f'[elapsed={elapsed:.3f}ms]'
         ))
 
-    def create_task_simple(self, task_fn):
+    async def forward(self, pipeline, code, ret):
+        """Forward stage output to the next stage of pipeline
+
+        Errors and timeouts short-circuit the pipeline, the last stage and
+        the failed one reply to the original caller.
+        """
+
+        if code == 200 and is_expired(pipeline):
+            ret = 'Pipeline stage timeout'
+            code = 504
+
+        next_stage = next_envelope(pipeline, ret) if code == 200 else None
+
+        if next_stage:
+            subject, envelope = next_stage
+            await self.nats.publish(subject, self.serializer.serialize(envelope))
+
+        elif pipeline['reply']:
+            await self.nats.publish(pipeline['reply'], self.serializer.serialize({
+                'code': code,
+                'data': ret
+            }))
+
+    def create_pipeline(self, stages, local_tasks):
+        """Returns message handler starting pipeline
+
+        The first stage is executed in place when its task is registered in
+        this worker, otherwise the message is forwarded to it.
+
+        :Params
+            - stages <list>: list of [subject, timeout]
+            - local_tasks <dict>: (task function, schema) of this worker by subject
+        """
+
+        first_subject = stages[0][0]
+        first_task_fn, first_schema = local_tasks.get(first_subject, (None, None))
+
+        async def run_pipeline(msg):
+            data = self.serializer.deserialize(msg.data)
+            subject, envelope = create_envelope(stages, msg.reply, data)
+
+            if first_task_fn is None:
+                await self.nats.publish(subject, self.serializer.serialize(envelope))
+                return
+
+            # run in place as the message of the first stage
+            await self.execute(
+                first_task_fn, Msg(subject=subject), data=envelope,
+                schema=first_schema, stage=True)
+
+        return self.track_pending(run_pipeline)
+
+    def check_out(self, data):
+        if self.claims:
+            return self.claims.check_out(data)
+
+        if ClaimCheckStore.sender_host(data) is not None:
+            raise ClaimCheckError('Claim-check is not enabled')
+
+        return data
+
+    def _record_execution(self, subject, fn_name, elapsed):
+        slowest = self._slowest_execution
+        if slowest is None or elapsed > slowest[2]:
+            self._slowest_execution = (subject, fn_name, elapsed)
+
+    def pop_slowest_execution(self):
+        """Returns slowest task execution since the last call and reset it
+        """
+
+        slowest, self._slowest_execution = self._slowest_execution, None
+        return slowest
+
+    def create_task_simple(self, task_fn, max_pending=None, schema=None, stage=False):
+        """Returns message handler executing task
+
+        Messages are refused with `OVERLOADED_RESPONSE` while `max_pending`
+        executions are in-flight. Handler of stage subject accepts pipeline
+        envelopes only.
+        """
+
         logging.debug(f'Create task [task_fn={task_fn.__name__}]')
 
+        async def execute_task(msg):
+            await self.execute(task_fn, msg, schema=schema, stage=stage)
+
+        return self.track_pending(execute_task, max_pending=max_pending)
+
+    def create_schema_handler(self, schema):
+        """Returns message handler replying schema of task, null if the
+        schema is unknown
+        """
+
+        description = self.serializer.serialize(schema.describe() if schema else None)
+
+        async def reply_schema(msg):
+            if msg.reply:
+                await self.nats.publish(msg.reply, description)
+
+        return reply_schema
+
+    def track_pending(self, handler, max_pending=None):
+        """Wrap message handler to be waited on draining
+        """
+
         async def run_task(msg):
-            await self.execute(task_fn, msg)
+            if max_pending and len(self._pending) >= max_pending:
+                logging.debug(f'Overloaded [subject={msg.subject}][pending={len(self._pending)}]')
+                if msg.reply:
+                    await self.nats.publish(msg.reply, self.overloaded_response)
+                return
+
+            task = asyncio.current_task()
+            self._pending.add(task)
+
+            try:
+                await handler(msg)
+            finally:
+                self._pending.discard(task)
 
         return run_task
 
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    async def wait_for_pending(self, timeout):
+        """Wait for in-flight task executions concurrently
+
+        All pending executions share a single deadline, progress is reported
+        every `DRAIN_PROGRESS_INTERVAL` seconds.
+
+        :Returns
+            <int>: number of executions which are not finished in time
+        """
+
+        deadline = time.monotonic() + timeout
+        pending = set(self._pending)
+
+        while pending:
+            remains = deadline - time.monotonic()
+            if remains <= 0:
+                break
+
+            logging.info((
+                'Drain - waiting in-flight tasks '
+                f'[pending={len(pending)}][remains={remains:.1f}s]'
+            ))
+            _, pending = await asyncio.wait(
+                pending, timeout=min(remains, DRAIN_PROGRESS_INTERVAL))
+
+        if pending:
+            logging.warning(f'Drain - deadline exceeded [pending={len(pending)}]')
+
+        return len(pending)
+
     def create_task(self, task_fn):
         logging.debug(f'Create task [task_fn={task_fn.__name__}]')
 
@@ -136,5 +391,7 @@ class NatsDriver(object):
         await self.nats.drain()
         logging.debug('Drained')
 
+        self.inbox.close()
+
         await self.nats.close()
         logging.debug('Closed')
@@ -1,6 +1,19 @@
 import logging
+import os
+import socket
+import tempfile
 
+from nats.aio.errors import ErrTimeout
+
+from metropolis.core.claimcheck import ClaimCheckStore
 from metropolis.core.driver import NatsDriver
+from metropolis.core.locality import LOCALITY_SUBJECT
+from metropolis.core.locality import LocalityRouter
+from metropolis.core.locality import scoped_subject
+from metropolis.core.partition import PARTITION_SUBJECT
+from metropolis.core.partition import PartitionTable
+from metropolis.core.profiler import LoopLagMonitor
+from metropolis.core.profiler import SamplingProfiler
 from metropolis.core.utils import get_module
 
 
@@ -17,6 +30,47 @@ DEFAULT_LOG_FORMAT = (
 DEFAULT_SERIALIZER_CLASS = 'metropolis.core.serializer.DefaultMessageSerializer'
 DEFAULT_NATS_URL = 'nats://localhost:4222'
 DEFAULT_UVLOOP_ENABLED = True
+DEFAULT_REQUEST_TIMEOUT = 0.5
+DEFAULT_REPLY_INBOX_MAX_PENDING = 10000
+DEFAULT_DRAIN_TIMEOUT = 10
+DEFAULT_DRAIN_DELAY = 5
+DEFAULT_HEARTBEAT_INTERVAL = 5
+DEFAULT_PIPELINE_STAGE_TIMEOUT = 30
+DEFAULT_PARTITIONS = 64
+DEFAULT_SCHEMA_VALIDATION_ENABLED = True
+DEFAULT_FANOUT_ENABLED = False
+DEFAULT_RATE_LIMIT_ROUTE = None
+DEFAULT_RATE_LIMIT_CLIENT = None
+DEFAULT_RATE_LIMIT_CLIENT_HEADER = None
+DEFAULT_RATE_LIMIT_MAX_KEYS = 100000
+DEFAULT_RATE_LIMIT_IDLE_TIMEOUT = 60
+DEFAULT_RATE_LIMIT_SYNC_INTERVAL = 1
+DEFAULT_CONCURRENCY_PER_REPLICA = None
+DEFAULT_FANOUT_BUFFER_SIZE = 100
+DEFAULT_NODE_NAME = None
+DEFAULT_ZONE_NAME = None
+DEFAULT_LOCALITY_MAX_PENDING = None
+DEFAULT_CLAIM_CHECK_ENABLED = False
+DEFAULT_CLAIM_CHECK_DIR = os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'metropolis')
+DEFAULT_CLAIM_CHECK_THRESHOLD = 64 * 1024
+DEFAULT_CLAIM_CHECK_TTL = 60
+DEFAULT_READINESS_FILE = None
+DEFAULT_LOOP_LAG_MONITOR_ENABLED = False
+DEFAULT_LOOP_LAG_INTERVAL = 0.5
+DEFAULT_LOOP_LAG_THRESHOLD = 0.1
+DEFAULT_PROFILE_DIR = tempfile.gettempdir()
+DEFAULT_PROFILE_DURATION = 10
+DEFAULT_PROFILE_MAX_DURATION = 60
+
+# Control signals which are handled by every executor
+CONTROL_SIGNAL_PROFILE = '__PROFILE__'
+
+# Executor lifecycle states
+EXECUTOR_STATE_STARTING = 'starting'
+EXECUTOR_STATE_READY = 'ready'
+EXECUTOR_STATE_DRAINING = 'draining'
+EXECUTOR_STATE_STOPPED = 'stopped'
 
 
 def set_logger(log_level, log_format):
@@ -25,8 +79,14 @@ def set_logger(log_level, log_format):
 
 
 class Executor(object):
+    state = EXECUTOR_STATE_STARTING
+
+    # sampling profiler of the running profile
+    _profiler = None
+
     def __init__(self, name, config):
         self.name = name
+        self.replica_id = f'{socket.gethostname()}.{os.getpid()}'
 
         self.config = {
             'log_level': getattr(config, 'LOG_LEVEL', DEFAULT_LOG_LEVEL),
@@ -35,7 +95,41 @@ class Executor(object):
             'serializer_class': getattr(config, 'SERIALIZER_CLASS', DEFAULT_SERIALIZER_CLASS),
             'uvloop_enabled': getattr(config, 'UVLOOP_ENABLED', DEFAULT_UVLOOP_ENABLED),
             'tasks': getattr(config, 'TASKS', []),
-            'control_lifecycle': getattr(config, 'CONTROL_LIFECYCLE_ENABLED', False)
+            'pipelines': getattr(config, 'PIPELINES', []),
+            'pipeline_stage_timeout': getattr(config, 'PIPELINE_STAGE_TIMEOUT', DEFAULT_PIPELINE_STAGE_TIMEOUT),
+            'control_lifecycle': getattr(config, 'CONTROL_LIFECYCLE_ENABLED', False),
+            'request_timeout': getattr(config, 'REQUEST_TIMEOUT', DEFAULT_REQUEST_TIMEOUT),
+            'reply_inbox_max_pending': getattr(
+                config, 'REPLY_INBOX_MAX_PENDING', DEFAULT_REPLY_INBOX_MAX_PENDING),
+            'drain_timeout': getattr(config, 'DRAIN_TIMEOUT', DEFAULT_DRAIN_TIMEOUT),
+            'drain_delay': getattr(config, 'DRAIN_DELAY', DEFAULT_DRAIN_DELAY),
+            'heartbeat_interval': getattr(config, 'HEARTBEAT_INTERVAL', DEFAULT_HEARTBEAT_INTERVAL),
+            'partitions': getattr(config, 'PARTITIONS', DEFAULT_PARTITIONS),
+            'schema_validation': getattr(config, 'SCHEMA_VALIDATION_ENABLED', DEFAULT_SCHEMA_VALIDATION_ENABLED),
+            'rate_limit_route': getattr(config, 'RATE_LIMIT_ROUTE', DEFAULT_RATE_LIMIT_ROUTE),
+            'rate_limit_client': getattr(config, 'RATE_LIMIT_CLIENT', DEFAULT_RATE_LIMIT_CLIENT),
+            'rate_limit_client_header': getattr(
+                config, 'RATE_LIMIT_CLIENT_HEADER', DEFAULT_RATE_LIMIT_CLIENT_HEADER),
+            'rate_limit_max_keys': getattr(config, 'RATE_LIMIT_MAX_KEYS', DEFAULT_RATE_LIMIT_MAX_KEYS),
+            'rate_limit_idle_timeout': getattr(config, 'RATE_LIMIT_IDLE_TIMEOUT', DEFAULT_RATE_LIMIT_IDLE_TIMEOUT),
+            'rate_limit_sync_interval': getattr(
+                config, 'RATE_LIMIT_SYNC_INTERVAL', DEFAULT_RATE_LIMIT_SYNC_INTERVAL),
+            'concurrency_per_replica': getattr(config, 'CONCURRENCY_PER_REPLICA', DEFAULT_CONCURRENCY_PER_REPLICA),
+            'fanout_enabled': getattr(config, 'FANOUT_ENABLED', DEFAULT_FANOUT_ENABLED),
+            'fanout_buffer_size': getattr(config, 'FANOUT_BUFFER_SIZE', DEFAULT_FANOUT_BUFFER_SIZE),
+            'node_name': getattr(config, 'NODE_NAME', DEFAULT_NODE_NAME),
+            'zone_name': getattr(config, 'ZONE_NAME', DEFAULT_ZONE_NAME),
+            'locality_max_pending': getattr(config, 'LOCALITY_MAX_PENDING', DEFAULT_LOCALITY_MAX_PENDING),
+            'claim_check_enabled': getattr(config, 'CLAIM_CHECK_ENABLED', DEFAULT_CLAIM_CHECK_ENABLED),
+            'claim_check_dir': getattr(config, 'CLAIM_CHECK_DIR', DEFAULT_CLAIM_CHECK_DIR),
+            'claim_check_threshold': getattr(config, 'CLAIM_CHECK_THRESHOLD', DEFAULT_CLAIM_CHECK_THRESHOLD),
+            'claim_check_ttl': getattr(config, 'CLAIM_CHECK_TTL', DEFAULT_CLAIM_CHECK_TTL),
+            'readiness_file': getattr(config, 'READINESS_FILE', DEFAULT_READINESS_FILE),
+            'loop_lag_monitor': getattr(config, 'LOOP_LAG_MONITOR_ENABLED', DEFAULT_LOOP_LAG_MONITOR_ENABLED),
+            'loop_lag_interval': getattr(config, 'LOOP_LAG_INTERVAL', DEFAULT_LOOP_LAG_INTERVAL),
+            'loop_lag_threshold': getattr(config, 'LOOP_LAG_THRESHOLD', DEFAULT_LOOP_LAG_THRESHOLD),
+            'profile_dir': getattr(config, 'PROFILE_DIR', DEFAULT_PROFILE_DIR),
+            'profile_max_duration': getattr(config, 'PROFILE_MAX_DURATION', DEFAULT_PROFILE_MAX_DURATION)
         }
 
         set_logger(self.config['log_level'], self.config['log_format'])
@@ -46,4 +140,154 @@ class Executor(object):
 
         logging.debug('Setup driver')
         self._driver = NatsDriver(
-            urls=self.config['nats_url'].split(','), serializer=serializer)
+            urls=self.config['nats_url'].split(','), serializer=serializer,
+            inbox_max_pending=self.config['reply_inbox_max_pending'])
+
+        logging.debug('Setup locality router')
+        self._locality = LocalityRouter(
+            scopes=(self.config['node_name'], self.config['zone_name']),
+            ttl=self.config['heartbeat_interval'] * 3)
+
+        # payloads are claim-checked only for node scoped requests, and
+        # replies only for requests which are claim-checked by this host
+        if self.config['claim_check_enabled'] and self.config['node_name']:
+            logging.debug('Setup claim-check store')
+            self._driver.claims = ClaimCheckStore(
+                directory=self.config['claim_check_dir'],
+                host=self.config['node_name'],
+                threshold=self.config['claim_check_threshold'],
+                ttl=self.config['claim_check_ttl'])
+
+        elif self.config['claim_check_enabled']:
+            logging.warning('Claim-check requires NODE_NAME, payloads are sent inline')
+
+        logging.debug('Setup partition table')
+        self._partitions = PartitionTable(ttl=self.config['heartbeat_interval'] * 3)
+
+    @property
+    def is_ready(self):
+        return self.state == EXECUTOR_STATE_READY
+
+    def set_state(self, state):
+        """Update lifecycle state and sync the readiness file
+
+        Orchestrators probe the readiness file (or `/_health/` of gateway)
+        so they stop routing to this process before it starts draining.
+        """
+
+        logging.info(f'Lifecycle state changed [{self.state} -> {state}]')
+        self.state = state
+
+        readiness_file = self.config['readiness_file']
+        if not readiness_file:
+            return
+
+        if state == EXECUTOR_STATE_READY:
+            with open(readiness_file, 'w') as f:
+                f.write(f'{os.getpid()}\n')
+
+        elif os.path.exists(readiness_file):
+            os.remove(readiness_file)
+
+    async def start_locality(self, nats):
+        if self._locality.scopes:
+            await nats.subscribe(
+                f'{LOCALITY_SUBJECT}.*', cb=self._locality.handle_announcement)
+
+    async def start_partitions(self, nats):
+        await nats.subscribe(
+            f'{PARTITION_SUBJECT}.*', cb=self._partitions.handle_announcement)
+
+    async def route_request(self, subject, payload, timeout):
+        """Request to the nearest replica
+
+        Tries same node, same zone and the global queue group in order.
+        Scoped replicas refusing the message as overloaded are skipped.
+        Large payloads to the same node replica are claim-checked.
+        """
+
+        claims = self._driver.claims
+        node_subject = claims and scoped_subject(subject, self.config['node_name'])
+
+        for candidate in self._locality.candidates(subject):
+            request_payload = payload
+            if candidate == node_subject:
+                request_payload = claims.check_in(payload)
+
+            try:
+                response = await self._driver.request(candidate, request_payload, timeout)
+
+            except ErrTimeout:
+                self._locality.evict(candidate)
+                raise
+
+            if candidate != subject and response.data == self._driver.overloaded_response:
+                logging.debug(f'Replica is overloaded, fallback [subject={candidate}]')
+                if claims:
+                    claims.release(request_payload)
+                continue
+
+            response.data = self._driver.check_out(response.data)
+            return response
+
+    def start_loop_monitor(self, loop):
+        if not self.config['loop_lag_monitor']:
+            return None
+
+        logging.debug('Start eventloop lag monitor')
+        monitor = LoopLagMonitor(
+            loop, self._driver,
+            interval=self.config['loop_lag_interval'],
+            threshold=self.config['loop_lag_threshold'])
+        monitor.start()
+
+        return monitor
+
+    async def handle_control(self, msg):
+        """Handle control signals common to executors
+
+        Message format is `{signal} {argument}`, e.g. `__PROFILE__ 30`
+
+        :Returns
+            <bool>: True if the signal is handled
+        """
+
+        control_signal, _, argument = msg.data.decode().partition(' ')
+        if control_signal != CONTROL_SIGNAL_PROFILE:
+            return False
+
+        response = self.start_profile(argument)
+        if msg.reply:
+            await self._driver.nats.publish(
+                msg.reply, self._driver.serializer.serialize(response))
+
+        return True
+
+    def start_profile(self, argument):
+        """Start sampling profiler unless one is running
+
+        Duration is clamped to `(0, PROFILE_MAX_DURATION]`.
+
+        :Returns
+            <dict>: duration and path of the profile, or error
+        """
+
+        try:
+            duration = float(argument or DEFAULT_PROFILE_DURATION)
+        except ValueError:
+            duration = None
+
+        # also refuses NaN
+        if duration is None or not duration > 0:
+            logging.warning(f'Invalid profile duration [duration={argument}]')
+            return {'error': f'Invalid profile duration: {argument}'}
+
+        if self._profiler is not None and self._profiler.is_running:
+            logging.warning('Profile is already running')
+            return {'error': 'Profile is already running'}
+
+        duration = min(duration, self.config['profile_max_duration'])
+        self._profiler = SamplingProfiler(self.config['profile_dir'], self.name)
+        path = self._profiler.start(duration)
+
+        return {'duration': duration, 'path': path}
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+
+class FanoutClient(object):
+    """Bounded message buffer of a connected http client
+
+    Client which does not consume messages fast enough to keep the buffer
+    under `buffer_size` is closed instead of buffering without limits.
+    """
+
+    closed = False
+
+    def __init__(self, subject, buffer_size):
+        self.subject = subject
+        self._queue = asyncio.Queue(maxsize=buffer_size)
+
+    def put(self, data):
+        if self.closed:
+            return
+
+        try:
+            self._queue.put_nowait(data)
+
+        except asyncio.QueueFull:
+            logging.warning(f'Slow fanout client is disconnected [subject={self.subject}]')
+            self.close()
+
+    async def get(self):
+        """Returns next message, None if the client is closed
+        """
+
+        if self.closed:
+            return None
+
+        return await self._queue.get()
+
+    def close(self):
+        self.closed = True
+
+        # wake up the consumer with end of stream
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+
+class FanoutHub(object):
+    """Share one nats subscription per subject among http clients
+    """
+
+    def __init__(self, driver, buffer_size):
+        self.driver = driver
+        self.buffer_size = buffer_size
+
+        # subject -> (subscription_id, {clients})
+        self._subscriptions = {}
+
+    @property
+    def client_count(self):
+        return sum(len(clients) for _, clients in self._subscriptions.values())
+
+    async def subscribe(self, subject):
+        client = FanoutClient(subject, self.buffer_size)
+
+        if subject not in self._subscriptions:
+            clients = set()
+            self._subscriptions[subject] = (None, clients)
+
+            try:
+                subscription_id = await self.driver.nats.subscribe(
+                    subject, cb=self.create_dispatcher(clients))
+
+            except Exception as e:
+                logging.error(f'Fanout subscription is failed [subject={subject}][error={e}]')
+
+                # clients joined in the meantime would never receive messages
+                del self._subscriptions[subject]
+                for waiting in clients:
+                    waiting.close()
+                raise
+
+            self._subscriptions[subject] = (subscription_id, clients)
+
+            logging.debug(f'Fanout subscription is created [subject={subject}]')
+
+        self._subscriptions[subject][1].add(client)
+        return client
+
+    async def unsubscribe(self, client):
+        client.close()
+
+        subscription_id, clients = self._subscriptions.get(client.subject, (None, set()))
+        clients.discard(client)
+
+        if clients or subscription_id is None:
+            return
+
+        del self._subscriptions[client.subject]
+        await self.driver.nats.unsubscribe(subscription_id)
+
+        logging.debug(f'Fanout subscription is removed [subject={client.subject}]')
+
+    @staticmethod
+    def create_dispatcher(clients):
+        async def dispatch(msg):
+            for client in list(clients):
+                client.put(msg.data)
+
+        return dispatch
+
+    def close(self):
+        for _, clients in self._subscriptions.values():
+            for client in clients:
+                client.close()
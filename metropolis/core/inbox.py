@@ -0,0 +1,75 @@
+import asyncio
+import itertools
+import logging
+
+from nats.aio.errors import ErrTimeout
+from nats.aio.nuid import NUID
+
+
+INBOX_PREFIX = '_INBOX'
+
+
+class InboxFullError(Exception):
+    pass
+
+
+class ReplyInbox(object):
+    """Multiplexed reply inbox of a connection
+
+    Owns a single wildcard subscription `_INBOX.{nuid}.*` and routes each
+    reply to the future waiting for its token, so request/reply does not
+    create any subscription per request.
+
+    Waiting futures are bounded by `max_pending` and always removed on
+    reply, timeout or cancellation.
+    """
+
+    _sid = None
+
+    def __init__(self, nats, max_pending):
+        self.nats = nats
+        self.max_pending = max_pending
+
+        self.prefix = f'{INBOX_PREFIX}.{NUID().next().decode()}.'
+        self._tokens = itertools.count()
+        self._futures = {}
+
+    @property
+    def pending_count(self):
+        return len(self._futures)
+
+    async def start(self):
+        self._sid = await self.nats.subscribe(f'{self.prefix}*', cb=self._route)
+        logging.debug(f'Reply inbox is subscribed [prefix={self.prefix}]')
+
+    async def _route(self, msg):
+        token = msg.subject[len(self.prefix):]
+        future = self._futures.pop(token, None)
+
+        # drop late replies of timed out requests
+        if future is not None and not future.done():
+            future.set_result(msg)
+
+    async def request(self, subject, payload, timeout):
+        if len(self._futures) >= self.max_pending:
+            raise InboxFullError(f'Too many pending requests [max={self.max_pending}]')
+
+        token = format(next(self._tokens), 'x')
+        future = asyncio.get_event_loop().create_future()
+        self._futures[token] = future
+
+        try:
+            await self.nats.publish_request(subject, f'{self.prefix}{token}', payload)
+            return await asyncio.wait_for(future, timeout)
+
+        except asyncio.TimeoutError:
+            raise ErrTimeout
+
+        finally:
+            self._futures.pop(token, None)
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+
+        self._futures.clear()
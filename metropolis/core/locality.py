@@ -0,0 +1,117 @@
+import logging
+import time
+
+
+# Subjects for announcing locality scoped subscriptions
+LOCALITY_SUBJECT = '_metropolis.locality'
+LOCALITY_SUBJECT_JOIN = f'{LOCALITY_SUBJECT}.join'
+LOCALITY_SUBJECT_LEAVE = f'{LOCALITY_SUBJECT}.leave'
+
+# Subjects for announcing task subjects of replicas
+REPLICA_SUBJECT = '_metropolis.replica'
+REPLICA_SUBJECT_JOIN = f'{REPLICA_SUBJECT}.join'
+REPLICA_SUBJECT_LEAVE = f'{REPLICA_SUBJECT}.leave'
+
+
+def scoped_subject(subject, scope):
+    """Locality scoped subject follows `_worker` suffix convention of gateway
+    """
+
+    return f'{subject}.{scope}'
+
+
+def encode_announcement(replica_id, subjects):
+    return ' '.join((replica_id, *subjects)).encode()
+
+
+def decode_announcement(data):
+    replica_id, *subjects = data.decode().split(' ')
+    return replica_id, subjects
+
+
+class ReplicaTable(object):
+    """Track alive replicas of subjects by their periodic announcements
+    """
+
+    # announcement subject of leaving replicas
+    leave_subject = REPLICA_SUBJECT_LEAVE
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+        # subject -> {replica_id: expires}
+        self._replicas = {}
+
+    def alive_count(self, subject):
+        now = time.monotonic()
+        return sum(
+            1 for expires in self._replicas.get(subject, {}).values() if expires > now)
+
+    def join(self, replica_id, subjects):
+        expires = time.monotonic() + self.ttl
+        for subject in subjects:
+            self._replicas.setdefault(subject, {})[replica_id] = expires
+
+        self._expire()
+
+    def leave(self, replica_id, subjects):
+        for subject in subjects:
+            replicas = self._replicas.get(subject, {})
+            replicas.pop(replica_id, None)
+
+            if not replicas:
+                self._replicas.pop(subject, None)
+
+    def evict(self, subject):
+        """Forget subject whose replicas are not responding
+        """
+
+        self._replicas.pop(subject, None)
+
+    def _expire(self):
+        now = time.monotonic()
+        for subject in list(self._replicas):
+            replicas = self._replicas[subject]
+            for replica_id in [r for r, expires in replicas.items() if expires <= now]:
+                del replicas[replica_id]
+
+            if not replicas:
+                del self._replicas[subject]
+
+    async def handle_announcement(self, msg):
+        replica_id, subjects = decode_announcement(msg.data)
+
+        if msg.subject == self.leave_subject:
+            logging.debug(f'Replica left [replica={replica_id}][subjects={subjects}]')
+            self.leave(replica_id, subjects)
+        else:
+            self.join(replica_id, subjects)
+
+
+class LocalityRouter(ReplicaTable):
+    """Track replicas serving node/zone scoped subjects
+
+    Workers announce their scoped subjects periodically, routers prefer the
+    scoped subject of the same node, then the same zone, and fall back to
+    the global queue group when no replica is alive in the scope.
+    """
+
+    leave_subject = LOCALITY_SUBJECT_LEAVE
+
+    def __init__(self, scopes, ttl):
+        super(LocalityRouter, self).__init__(ttl)
+
+        # ordered by preference, e.g. (node, zone)
+        self.scopes = [scope for scope in scopes if scope]
+
+    def candidates(self, subject):
+        """Yield subjects to request in order, ends with the global subject
+        """
+
+        for scope in self.scopes:
+            scoped = scoped_subject(subject, scope)
+
+            if self.alive_count(scoped):
+                yield scoped
+
+        yield subject
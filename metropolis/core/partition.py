@@ -0,0 +1,157 @@
+import bisect
+import logging
+import time
+import zlib
+
+
+# Subjects for announcing members of partitioned tasks
+PARTITION_SUBJECT = '_metropolis.partition'
+PARTITION_SUBJECT_JOIN = f'{PARTITION_SUBJECT}.join'
+PARTITION_SUBJECT_LEAVE = f'{PARTITION_SUBJECT}.leave'
+
+DEFAULT_VIRTUAL_NODES = 64
+
+
+def stable_hash(value):
+    return zlib.crc32(str(value).encode())
+
+
+def partition_of(key, partitions):
+    return stable_hash(key) % partitions
+
+
+def partition_subject(subject, partition):
+    return f'{subject}.p{partition}'
+
+
+def encode_announcement(replica_id, subject, key, partitions):
+    return f'{replica_id} {subject} {key} {partitions}'.encode()
+
+
+def decode_announcement(data):
+    replica_id, subject, key, partitions = data.decode().split(' ')
+    return replica_id, subject, key, int(partitions)
+
+
+class HashRing(object):
+    """Consistent hash ring of members
+
+    Each member is placed `virtual_nodes` times on the ring, so only the
+    partitions next to a joining or leaving member change their owner.
+    """
+
+    def __init__(self, members, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        ring = sorted(
+            (stable_hash(f'{member}#{i}'), member)
+            for member in members for i in range(virtual_nodes))
+
+        self._hashes = [h for h, _ in ring]
+        self._members = [member for _, member in ring]
+
+    def owner(self, partition):
+        if not self._members:
+            return None
+
+        index = bisect.bisect(self._hashes, stable_hash(f'partition#{partition}'))
+        return self._members[index % len(self._members)]
+
+
+class PartitionTable(object):
+    """Members and routing table of partitioned tasks
+
+    Workers announce `(subject, key, partitions)` of their partitioned tasks
+    periodically. Workers claim partitions they own on the ring of alive
+    members, callers route messages to the partition subject of the key.
+    """
+
+    # called with subject when members of the subject are changed
+    on_change = None
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+        # subject -> (key, partitions)
+        self._tasks = {}
+        # subject -> {replica_id: expires}
+        self._members = {}
+        # subject -> HashRing
+        self._rings = {}
+
+    def join(self, replica_id, subject, key, partitions):
+        self._tasks[subject] = (key, partitions)
+        members = self._members.setdefault(subject, {})
+
+        is_new = replica_id not in members
+        members[replica_id] = time.monotonic() + self.ttl
+
+        if is_new:
+            self._changed(subject)
+
+    def leave(self, replica_id, subject):
+        members = self._members.get(subject, {})
+        if members.pop(replica_id, None) is not None:
+            self._changed(subject)
+
+    def expire(self):
+        now = time.monotonic()
+        for subject, members in self._members.items():
+            expired = [r for r, expires in members.items() if expires <= now]
+            for replica_id in expired:
+                del members[replica_id]
+
+            if expired:
+                self._changed(subject)
+
+    def _changed(self, subject):
+        members = self._members.get(subject, {})
+        logging.info(f'Partition members are changed [subject={subject}][members={len(members)}]')
+
+        self._rings[subject] = HashRing(members)
+        if self.on_change:
+            self.on_change(subject)
+
+    def is_partitioned(self, subject):
+        return bool(self._members.get(subject))
+
+    def owned_partitions(self, subject, replica_id):
+        _, partitions = self._tasks[subject]
+        ring = self._rings[subject]
+
+        return {p for p in range(partitions) if ring.owner(p) == replica_id}
+
+    def resolve(self, subject, key):
+        """Returns partition subject of the key, subject itself if unknown
+        """
+
+        # no member claims partitions, use the global queue group
+        if key is None or not self.is_partitioned(subject):
+            return subject
+
+        _, partitions = self._tasks[subject]
+        return partition_subject(subject, partition_of(key, partitions))
+
+    def route(self, subject, data):
+        """Returns partition subject by partition key value in message data
+        """
+
+        if not self.is_partitioned(subject):
+            return subject
+
+        key, _ = self._tasks[subject]
+        value = data.get(key)
+
+        # query params of gateway requests are lists
+        if isinstance(value, list):
+            value = value[0] if value else None
+
+        return self.resolve(subject, value)
+
+    async def handle_announcement(self, msg):
+        replica_id, subject, key, partitions = decode_announcement(msg.data)
+
+        if msg.subject == PARTITION_SUBJECT_LEAVE:
+            self.leave(replica_id, subject)
+        else:
+            self.join(replica_id, subject, key, partitions)
+
+        self.expire()
@@ -0,0 +1,114 @@
+import time
+
+
+# message key of pipeline envelope
+PIPELINE_KEY = '__pipeline__'
+
+# Subject prefix of stage messages, gateway never routes to `_` subjects
+STAGE_SUBJECT = '_metropolis.stage'
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+def stage_subject(subject):
+    return f'{STAGE_SUBJECT}.{subject}'
+
+
+def normalize_stages(stages, default_timeout):
+    """Returns stages as list of [subject, timeout]
+
+    :Params
+        - stages <list>: subjects or (subject, timeout) tuples
+        - default_timeout <float>: timeout of stages without timeout (sec)
+    """
+
+    return [
+        [stage, default_timeout] if isinstance(stage, str) else list(stage)
+        for stage in stages
+    ]
+
+
+def stage_input(ret):
+    """Output of stage is passed as keyword args of the next stage
+
+    Non dict output is passed as `data` argument.
+    """
+
+    return ret if isinstance(ret, dict) else {'data': ret}
+
+
+def create_envelope(stages, reply, data):
+    """Wrap message to the first stage of pipeline
+
+    Envelope carries remaining stages and the reply subject of the original
+    caller, so that each stage forwards its output directly to the next
+    stage and only the last one replies to the caller.
+
+    :Returns
+        <(str, dict)>: tuple of the first stage message subject, envelope
+    """
+
+    (subject, timeout), *remains = stages
+
+    return stage_subject(subject), {
+        PIPELINE_KEY: {
+            'stages': remains,
+            'reply': reply or '',
+            'deadline': time.time() + timeout
+        },
+        'data': data
+    }
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_stage(stage):
+    return (
+        isinstance(stage, list) and len(stage) == 2
+        and isinstance(stage[0], str) and _is_number(stage[1]))
+
+
+def open_envelope(data):
+    """Returns tuple of pipeline and task args of stage message
+
+    :Raises
+        EnvelopeError: message is not a well-formed envelope
+    """
+
+    if not isinstance(data, dict) or 'data' not in data:
+        raise EnvelopeError('Message should be a pipeline envelope')
+
+    pipeline = data.get(PIPELINE_KEY)
+    if not isinstance(pipeline, dict):
+        raise EnvelopeError(f'{PIPELINE_KEY}: invalid value')
+
+    stages = pipeline.get('stages')
+    if not isinstance(stages, list) or not all(_is_stage(stage) for stage in stages):
+        raise EnvelopeError('stages: invalid value')
+
+    if not isinstance(pipeline.get('reply'), str):
+        raise EnvelopeError('reply: invalid value')
+
+    if not _is_number(pipeline.get('deadline')):
+        raise EnvelopeError('deadline: invalid value')
+
+    return pipeline, data['data']
+
+
+def is_expired(pipeline):
+    return time.time() > pipeline['deadline']
+
+
+def next_envelope(pipeline, ret):
+    """Returns tuple of the next stage subject and envelope, None if the
+    pipeline is finished
+    """
+
+    if not pipeline['stages']:
+        return None
+
+    return create_envelope(pipeline['stages'], pipeline['reply'], stage_input(ret))
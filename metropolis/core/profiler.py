@@ -0,0 +1,130 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+
+class LoopLagMonitor(object):
+    """Detect callbacks blocking the eventloop
+
+    Sleeps `interval` seconds repeatedly and measures how late it wakes up.
+    Lag above `threshold` is logged with the slowest task execution which
+    is recorded by the driver in the meantime.
+    """
+
+    _task = None
+
+    def __init__(self, loop, driver, interval, threshold):
+        self.loop = loop
+        self.driver = driver
+        self.interval = interval
+        self.threshold = threshold
+
+    def start(self):
+        self._task = self.loop.create_task(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            started = self.loop.time()
+            await asyncio.sleep(self.interval)
+
+            lag = self.loop.time() - started - self.interval
+            slowest = self.driver.pop_slowest_execution()
+
+            if lag < self.threshold:
+                continue
+
+            if slowest:
+                subject, fn_name, elapsed = slowest
+                logging.warning((
+                    'Eventloop is blocked. '
+                    f'[lag={lag * 1000:.3f}ms]'
+                    f'[subject={subject}][fn={fn_name}]'
+                    f'[elapsed={elapsed * 1000:.3f}ms]'
+                ))
+            else:
+                logging.warning(f'Eventloop is blocked. [lag={lag * 1000:.3f}ms]')
+
+
+class SamplingProfiler(object):
+    """Time-boxed sampling profiler for the eventloop thread
+
+    Samples the target thread's stack from a background thread, so it can
+    be started in a running process without blocking the eventloop.
+    Result is written in collapsed-stack format which is consumable by
+    flamegraph tools (`flamegraph.pl`, `speedscope`, ...).
+    """
+
+    _thread = None
+
+    def __init__(self, directory, name, interval=0.005):
+        self.directory = directory
+        self.name = name
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration):
+        """Start sampling in background
+
+        :Params
+            - duration <float>: sampling time (sec)
+
+        :Returns
+            <str>: path of the collapsed-stack file to be written
+        """
+
+        path = os.path.join(self.directory, (
+            f'{self.name}-{os.getpid()}-{int(time.time())}.collapsed'))
+
+        self._thread = threading.Thread(
+            target=self._run, args=(duration, path), daemon=True)
+        self._thread.start()
+
+        logging.info(f'Profile started [duration={duration}s][path={path}]')
+        return path
+
+    def sample(self, duration):
+        samples = collections.Counter()
+        deadline = time.monotonic() + duration
+
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+
+            samples[self.collapse(frame)] += 1
+            time.sleep(self.interval)
+
+        return samples
+
+    @staticmethod
+    def collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+
+        return ';'.join(reversed(stack))
+
+    def _run(self, duration, path):
+        samples = self.sample(duration)
+
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+
+        logging.info(f'Profile finished [samples={sum(samples.values())}][path={path}]')
@@ -0,0 +1,229 @@
+import collections
+import json
+import logging
+import time
+
+
+# Subject for sharing consumed tokens among gateways
+RATE_LIMIT_SUBJECT = '_metropolis.ratelimit'
+
+DEFAULT_MAX_KEYS = 100000
+DEFAULT_IDLE_TIMEOUT = 60
+
+# sync message size, well under the default nats max_payload (1MB)
+DEFAULT_SYNC_PAYLOAD_SIZE = 256 * 1024
+
+ADMISSION_ROUTE_LIMITED = 429
+ADMISSION_CLIENT_LIMITED = 429
+ADMISSION_CONCURRENCY_LIMITED = 503
+
+ADMISSION_REASONS = {
+    ADMISSION_ROUTE_LIMITED: 'Too many requests',
+    ADMISSION_CONCURRENCY_LIMITED: 'Too many concurrent requests',
+}
+
+
+class TokenBucketTable(object):
+    """Bounded table of token buckets
+
+    Buckets are kept in least recently used order, so idle buckets are
+    evicted from the head and the least recently used one is dropped when
+    the table is full. A bucket is a `[tokens, updated]` pair, refilled
+    lazily on consume.
+    """
+
+    def __init__(self, rate, burst, max_keys=DEFAULT_MAX_KEYS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.idle_timeout = idle_timeout
+
+        self._buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _get_bucket(self, key, now):
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+
+            bucket = self._buckets[key] = [self.burst, now]
+            return bucket
+
+        self._buckets.move_to_end(key)
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        return bucket
+
+    def has_tokens(self, key, tokens=1, now=None):
+        now = time.monotonic() if now is None else now
+        self.evict_idle(now)
+
+        return self._get_bucket(key, now)[0] >= tokens
+
+    def consume(self, key, tokens=1, now=None):
+        """Returns True if tokens are consumed
+        """
+
+        now = time.monotonic() if now is None else now
+        if not self.has_tokens(key, tokens, now):
+            return False
+
+        self._buckets[key][0] -= tokens
+        return True
+
+    def drain(self, key, tokens, now=None):
+        """Take tokens consumed by other gateways, down to `-burst`
+
+        Only known buckets are drained, so that keys of the other gateways
+        do not evict the local ones.
+        """
+
+        if key not in self._buckets:
+            return
+
+        now = time.monotonic() if now is None else now
+        bucket = self._get_bucket(key, now)
+        bucket[0] = max(-self.burst, bucket[0] - tokens)
+
+    def evict_idle(self, now):
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if now - updated < self.idle_timeout:
+                break
+
+            del self._buckets[key]
+
+
+class AdmissionController(object):
+    """Admission control of gateway requests
+
+    - per route and per client token buckets (429)
+    - in-flight requests per route capped by alive replica count (503)
+
+    Consumed tokens are accumulated and shared with the other gateways by
+    `sync_payloads` / `apply_sync`, so each gateway debits the whole cluster
+    consumption from its buckets.
+    """
+
+    def __init__(self, replica_id, route_limit=None, client_limit=None,
+                 concurrency_per_replica=None, replicas=None,
+                 max_keys=DEFAULT_MAX_KEYS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        :Params
+            - route_limit <(float, int)>: rate and burst of each route
+            - client_limit <(float, int)>: rate and burst of each client
+            - concurrency_per_replica <int>: in-flight requests per replica
+            - replicas <ReplicaTable>: alive replicas of routes
+        """
+
+        self.replica_id = replica_id
+        self.concurrency_per_replica = concurrency_per_replica
+        self.replicas = replicas
+
+        self._routes = TokenBucketTable(
+            *route_limit, max_keys=max_keys, idle_timeout=idle_timeout) if route_limit else None
+        self._clients = TokenBucketTable(
+            *client_limit, max_keys=max_keys, idle_timeout=idle_timeout) if client_limit else None
+
+        # route -> in-flight requests
+        self._inflight = collections.Counter()
+
+        # consumed tokens since the last sync
+        self._consumed_routes = collections.Counter()
+        self._consumed_clients = collections.Counter()
+
+    def admit(self, route, client):
+        """Returns status code of rejection, None if the request is admitted
+
+        Admitted request should be released by `release(route)`. Tokens
+        are consumed only by admitted requests.
+        """
+
+        now = time.monotonic()
+
+        if self._routes is not None and not self._routes.has_tokens(route, now=now):
+            return ADMISSION_ROUTE_LIMITED
+
+        if self._clients is not None and not self._clients.has_tokens(client, now=now):
+            return ADMISSION_CLIENT_LIMITED
+
+        if self.concurrency_per_replica and self.replicas:
+            replicas = self.replicas.alive_count(route)
+
+            # no replica is known, do not guess the capacity
+            if replicas and self._inflight[route] >= replicas * self.concurrency_per_replica:
+                return ADMISSION_CONCURRENCY_LIMITED
+
+        if self._routes is not None:
+            self._routes.consume(route, now=now)
+        if self._clients is not None:
+            self._clients.consume(client, now=now)
+
+        self._inflight[route] += 1
+        self._consumed_routes[route] += 1
+        self._consumed_clients[client] += 1
+
+        return None
+
+    def release(self, route):
+        self._inflight[route] -= 1
+        if self._inflight[route] <= 0:
+            del self._inflight[route]
+
+    def sync_payloads(self, max_size=DEFAULT_SYNC_PAYLOAD_SIZE):
+        """Returns consumed tokens since the last call, split into payloads
+        of about `max_size` bytes
+        """
+
+        consumed = {'routes': self._consumed_routes, 'clients': self._consumed_clients}
+        self._consumed_routes = collections.Counter()
+        self._consumed_clients = collections.Counter()
+
+        payloads = []
+        chunk = {'routes': {}, 'clients': {}}
+        size = 0
+
+        for field, counter in consumed.items():
+            for key, tokens in counter.items():
+                # `"key": tokens, `
+                entry_size = len(json.dumps(key)) + len(str(tokens)) + 4
+                if size and size + entry_size > max_size:
+                    payloads.append(self._encode_sync(chunk))
+                    chunk = {'routes': {}, 'clients': {}}
+                    size = 0
+
+                chunk[field][key] = tokens
+                size += entry_size
+
+        if size:
+            payloads.append(self._encode_sync(chunk))
+
+        return payloads
+
+    def _encode_sync(self, chunk):
+        return json.dumps({'replica': self.replica_id, **chunk}).encode()
+
+    def apply_sync(self, data):
+        consumed = json.loads(data.decode())
+        if consumed['replica'] == self.replica_id:
+            return
+
+        now = time.monotonic()
+        if self._routes is not None:
+            for route, tokens in consumed['routes'].items():
+                self._routes.drain(route, tokens, now=now)
+
+        if self._clients is not None:
+            for client, tokens in consumed['clients'].items():
+                self._clients.drain(client, tokens, now=now)
+
+    async def handle_sync(self, msg):
+        try:
+            self.apply_sync(msg.data)
+        except (ValueError, KeyError) as e:
+            logging.warning(f'Invalid rate limit sync message [error={e}]')
@@ -0,0 +1,313 @@
+import asyncio
+import inspect
+import logging
+import time
+import typing
+
+from nats.aio.errors import ErrTimeout
+
+
+# Subject prefix of task schema requests
+SCHEMA_SUBJECT = '_metropolis.schema'
+
+DEFAULT_SCHEMA_CACHE_TTL = 60
+DEFAULT_SCHEMA_CACHE_SIZE = 1024
+
+_NoneType = type(None)
+
+
+class ValidationError(Exception):
+    pass
+
+
+def _unwrap(value):
+    # query params of gateway requests are lists
+    if isinstance(value, list) and len(value) == 1:
+        return value[0]
+
+    return value
+
+
+def _convert_int(value):
+    value = _unwrap(value)
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError
+    return int(value)
+
+
+def _convert_float(value):
+    value = _unwrap(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError
+    return float(value)
+
+
+def _convert_bool(value):
+    value = _unwrap(value)
+    if isinstance(value, bool):
+        return value
+    if value in ('true', '1', 1):
+        return True
+    if value in ('false', '0', 0):
+        return False
+    raise ValueError
+
+
+def _convert_str(value):
+    value = _unwrap(value)
+    if not isinstance(value, str):
+        raise ValueError
+    return value
+
+
+def _convert_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _convert_dict(value):
+    if not isinstance(value, dict):
+        raise ValueError
+    return value
+
+
+def _identity(value):
+    return value
+
+
+CONVERTERS = {
+    int: _convert_int,
+    float: _convert_float,
+    bool: _convert_bool,
+    str: _convert_str,
+    list: _convert_list,
+    dict: _convert_dict,
+}
+
+
+def _resolve_type(annotation):
+    """Returns tuple of (python type or None, nullable)
+    """
+
+    if getattr(annotation, '__origin__', None) is typing.Union:
+        args = [arg for arg in annotation.__args__ if arg is not _NoneType]
+        nullable = len(args) < len(annotation.__args__)
+        if len(args) == 1:
+            return _resolve_type(args[0])[0], nullable
+        return None, nullable
+
+    # generic aliases, e.g. List[int] -> list
+    annotation = getattr(annotation, '__origin__', annotation)
+    return (annotation if annotation in CONVERTERS else None), False
+
+
+class TaskSchema(object):
+    """Argument binding and validation of task
+
+    Compiled once at task registration into a list of field converters,
+    so binding a message is a single pass over the fields.
+    """
+
+    def __init__(self, fields, accepts_extra=False):
+        """
+        :Params
+            - fields <list>: list of (name, type, required, nullable)
+            - accepts_extra <bool>: task accepts unknown keyword args
+        """
+
+        self.fields = fields
+        self.accepts_extra = accepts_extra
+
+        self._names = {name for name, *_ in fields}
+        self._converters = [
+            (name, CONVERTERS.get(field_type, _identity), required, nullable)
+            for name, field_type, required, nullable in fields
+        ]
+
+    @classmethod
+    def from_function(cls, task_fn):
+        """Derive schema from signature and type hints of task function
+        """
+
+        try:
+            hints = typing.get_type_hints(task_fn)
+        except Exception:
+            hints = {}
+
+        fields = []
+        accepts_extra = False
+
+        for name, param in inspect.signature(task_fn).parameters.items():
+            if param.kind == param.VAR_KEYWORD:
+                accepts_extra = True
+                continue
+
+            if param.kind not in (param.POSITIONAL_OR_KEYWORD, param.KEYWORD_ONLY):
+                continue
+
+            field_type, nullable = _resolve_type(hints.get(name))
+            required = param.default is param.empty
+            nullable = nullable or param.default is None
+
+            fields.append((name, field_type, required, nullable))
+
+        return cls(fields, accepts_extra)
+
+    @classmethod
+    def from_dict(cls, spec, accepts_extra=False):
+        """Build schema from explicit field types, e.g. `{'user_id': int}`
+
+        Fields of `typing.Optional` type are not required.
+        """
+
+        fields = []
+        for name, annotation in spec.items():
+            field_type, nullable = _resolve_type(annotation)
+            fields.append((name, field_type, not nullable, nullable))
+
+        return cls(fields, accepts_extra)
+
+    @classmethod
+    def from_description(cls, description):
+        """Build schema from `describe()` result, types are informative only
+        """
+
+        fields = [
+            (name, None, field['required'], field['nullable'])
+            for name, field in description['fields'].items()
+        ]
+
+        return cls(fields, description['accepts_extra'])
+
+    def describe(self):
+        return {
+            'fields': {
+                name: {
+                    'type': field_type.__name__ if field_type else None,
+                    'required': required,
+                    'nullable': nullable
+                }
+                for name, field_type, required, nullable in self.fields
+            },
+            'accepts_extra': self.accepts_extra
+        }
+
+    def bind(self, data):
+        """Returns validated and converted keyword args of task
+
+        Keys starting with `_` (e.g. `_worker`) are routing params and
+        dropped unless the task accepts extra args.
+
+        :Raises
+            ValidationError: with all invalid fields of the message
+        """
+
+        if not isinstance(data, dict):
+            raise ValidationError('Message should be a mapping of arguments')
+
+        errors = []
+        kwargs = {}
+
+        for name, convert, required, nullable in self._converters:
+            if name not in data:
+                if required:
+                    errors.append(f'{name}: required')
+                continue
+
+            value = data[name]
+            if value is None and nullable:
+                kwargs[name] = None
+                continue
+
+            try:
+                kwargs[name] = convert(value)
+            except (TypeError, ValueError):
+                errors.append(f'{name}: invalid value')
+
+        for name in data:
+            if name in self._names:
+                continue
+
+            if self.accepts_extra:
+                kwargs[name] = data[name]
+            elif not name.startswith('_'):
+                errors.append(f'{name}: unknown argument')
+
+        if errors:
+            raise ValidationError(', '.join(errors))
+
+        return kwargs
+
+    def validate(self, data):
+        """Check presence of the fields without conversion
+        """
+
+        missing = [
+            name for name, _, required, _ in self.fields
+            if required and name not in data]
+        unknown = [] if self.accepts_extra else [
+            name for name in data if name not in self._names and not name.startswith('_')]
+
+        errors = [f'{name}: required' for name in missing] + [
+            f'{name}: unknown argument' for name in unknown]
+
+        if errors:
+            raise ValidationError(', '.join(errors))
+
+
+class SchemaRegistry(object):
+    """Cache of task schemas requested from workers
+
+    Schemas are fetched in background with one request per subject at a
+    time, requests are not validated while the schema is loading. Subjects
+    without schema (or no worker answering in time) are cached as None, so
+    validation at the edge is skipped without repeating requests.
+    """
+
+    def __init__(self, driver, timeout, ttl=DEFAULT_SCHEMA_CACHE_TTL, max_size=DEFAULT_SCHEMA_CACHE_SIZE):
+        self.driver = driver
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # subject -> (schema, expires)
+        self._schemas = {}
+        # subject -> fetching task
+        self._loading = {}
+
+    def get(self, subject):
+        """Returns cached schema, None while it is loading
+
+        Expired schema is returned until it is refreshed.
+        """
+
+        schema, expires = self._schemas.get(subject, (None, 0))
+
+        if expires <= time.monotonic() and subject not in self._loading \
+                and len(self._loading) < self.max_size:
+            self._loading[subject] = asyncio.ensure_future(self._fetch(subject))
+
+        return schema
+
+    async def _fetch(self, subject):
+        try:
+            response = await self.driver.request(
+                f'{SCHEMA_SUBJECT}.{subject}', b'', self.timeout)
+            description = self.driver.serializer.deserialize(response.data)
+            schema = description and TaskSchema.from_description(description)
+
+        except ErrTimeout:
+            schema = None
+
+        except Exception as e:
+            logging.warning(f'Invalid schema [subject={subject}][error={e}]')
+            schema = None
+
+        finally:
+            self._loading.pop(subject, None)
+
+        # evict the oldest entry, paths of gateway requests are unbounded
+        if subject not in self._schemas and len(self._schemas) >= self.max_size:
+            del self._schemas[next(iter(self._schemas))]
+
+        self._schemas[subject] = (schema, time.monotonic() + self.ttl)
+        return schema
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+import unittest
+
+from metropolis.core.claimcheck import ClaimCheckError
+from metropolis.core.claimcheck import ClaimCheckStore
+
+
+class TestClaimCheckStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ClaimCheckStore(self.directory, host='node-1', threshold=4, ttl=60)
+
+    def test_small_payload_should_be_inline(self):
+        reference = self.store.check_in(b'abc')
+
+        self.assertFalse(self.store.is_claim(reference))
+        self.assertEqual(self.store.check_out(reference), b'abc')
+        self.assertEqual(self.store.check_out(b'abc'), b'abc')
+
+    def test_sender_host_should_be_known_from_reference(self):
+        self.assertEqual(self.store.sender_host(self.store.check_in(b'abc')), 'node-1')
+        self.assertEqual(self.store.sender_host(self.store.check_in(b'hello world')), 'node-1')
+        self.assertIsNone(self.store.sender_host(b'abc'))
+
+    def test_large_payload_should_be_claim_checked(self):
+        reference = self.store.check_in(b'hello world')
+
+        self.assertTrue(self.store.is_claim(reference))
+        self.assertEqual(self.store.check_out(reference), b'hello world')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_claim_should_be_removed_after_last_reference(self):
+        reference = self.store.check_in(b'hello world', refs=2)
+
+        self.assertEqual(self.store.check_out(reference), b'hello world')
+        self.assertEqual(self.store.check_out(reference), b'hello world')
+
+        with self.assertRaises(ClaimCheckError):
+            self.store.check_out(reference)
+
+    def test_claim_of_another_host_should_not_be_checked_out(self):
+        store = ClaimCheckStore(self.directory, host='node-2', threshold=4, ttl=60)
+        reference = store.check_in(b'hello world')
+
+        with self.assertRaises(ClaimCheckError):
+            self.store.check_out(reference)
+
+    def test_expired_claim_should_be_swept(self):
+        self.store.check_in(b'hello world')
+        self.store.ttl = -1
+        time.sleep(0.01)
+
+        self.store.sweep()
+
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,115 @@
+import asyncio
+import tempfile
+import unittest
+
+from nats.aio.client import Msg
+
+from metropolis.core.claimcheck import ClaimCheckStore
+from metropolis.core.driver import NatsDriver
+from metropolis.core.schema import TaskSchema
+from metropolis.core.serializer import JsonMessageSerializer
+from metropolis.core.utils import simple_eventloop
+
+
+class TestNatsDriverPending(unittest.TestCase):
+    def test_pending_tasks_should_be_waited_concurrently(self):
+        driver = NatsDriver(['nats://localhost:4222'], JsonMessageSerializer)
+
+        async def wait_pending():
+            for _ in range(5):
+                driver._pending.add(asyncio.ensure_future(asyncio.sleep(0.2)))
+
+            return await driver.wait_for_pending(timeout=1)
+
+        with simple_eventloop() as loop:
+            started = loop.time()
+            remains = loop.run_until_complete(wait_pending())
+            elapsed = loop.time() - started
+
+        self.assertEqual(remains, 0)
+        self.assertLess(elapsed, 0.5)
+
+    def test_pending_tasks_should_be_bounded_by_deadline(self):
+        driver = NatsDriver(['nats://localhost:4222'], JsonMessageSerializer)
+
+        async def wait_pending():
+            driver._pending.add(asyncio.ensure_future(asyncio.sleep(0.1)))
+            driver._pending.add(asyncio.ensure_future(asyncio.sleep(10)))
+
+            return await driver.wait_for_pending(timeout=0.3)
+
+        with simple_eventloop() as loop:
+            remains = loop.run_until_complete(wait_pending())
+
+        self.assertEqual(remains, 1)
+
+
+def get_user(user_id: int):
+    raise AssertionError('task should not be executed')
+
+
+def get_report(name: str):
+    return name * 100
+
+
+class RecordingNats(object):
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, subject, payload):
+        self.published.append((subject, JsonMessageSerializer.deserialize(payload)))
+
+
+class TestNatsDriverExecute(unittest.TestCase):
+    def test_invalid_message_should_be_rejected_before_task(self):
+        driver = NatsDriver(['nats://localhost:4222'], JsonMessageSerializer)
+        driver.nats = RecordingNats()
+        msg = Msg(subject='user.get', reply='_INBOX.1', data=b'{"user_id": "abc"}')
+
+        with simple_eventloop() as loop:
+            loop.run_until_complete(driver.execute(
+                get_user, msg, schema=TaskSchema.from_function(get_user)))
+
+        self.assertEqual(
+            driver.nats.published,
+            [('_INBOX.1', {'code': 400, 'data': 'user_id: invalid value'})])
+
+
+class RawNats(object):
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, subject, payload):
+        self.published.append((subject, payload))
+
+
+class TestNatsDriverClaimCheck(unittest.TestCase):
+    def setUp(self):
+        self.driver = NatsDriver(['nats://localhost:4222'], JsonMessageSerializer)
+        self.driver.nats = RawNats()
+        self.driver.claims = ClaimCheckStore(
+            tempfile.mkdtemp(), host='node-1', threshold=16, ttl=60)
+
+    def execute(self, data):
+        msg = Msg(subject='report.get.node-1', reply='_INBOX.1', data=data)
+        with simple_eventloop() as loop:
+            loop.run_until_complete(self.driver.execute(get_report, msg))
+
+        return self.driver.nats.published[-1][1]
+
+    def test_reply_should_be_claim_checked_for_local_requester(self):
+        reply = self.execute(self.driver.claims.check_in(b'{"name": "foo"}'))
+
+        self.assertTrue(self.driver.claims.is_claim(reply))
+
+    def test_reply_should_be_inline_for_unknown_requester(self):
+        reply = self.execute(b'{"name": "foo"}')
+
+        self.assertEqual(JsonMessageSerializer.deserialize(reply)['code'], 200)
+
+    def test_expired_claim_should_be_replied(self):
+        reply = self.execute(b'\x00claim:node-1 deadbeef')
+
+        response = JsonMessageSerializer.deserialize(self.driver.claims.check_out(reply))
+        self.assertEqual(response['code'], 400)
+        self.assertIn('Claim is expired', response['data'])
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+from metropolis.core.executor import Executor
+from metropolis.core.executor import EXECUTOR_STATE_DRAINING
+from metropolis.core.executor import EXECUTOR_STATE_READY
+from metropolis.core.executor import EXECUTOR_STATE_STARTING
+
+
+class Config(object):
+    READINESS_FILE = os.path.join(tempfile.gettempdir(), 'metropolis-ready')
+
+
+class TestExecutorState(unittest.TestCase):
+    def test_executor_should_be_starting(self):
+        executor = Executor('test-executor', None)
+
+        self.assertEqual(executor.state, EXECUTOR_STATE_STARTING)
+        self.assertFalse(executor.is_ready)
+
+    def test_readiness_file_should_follow_state(self):
+        executor = Executor('test-executor', Config)
+
+        executor.set_state(EXECUTOR_STATE_READY)
+        self.assertTrue(executor.is_ready)
+        self.assertTrue(os.path.exists(Config.READINESS_FILE))
+
+        executor.set_state(EXECUTOR_STATE_DRAINING)
+        self.assertFalse(executor.is_ready)
+        self.assertFalse(os.path.exists(Config.READINESS_FILE))
+
+
+class TestExecutorProfile(unittest.TestCase):
+    def setUp(self):
+        self.executor = Executor('test-executor', Config)
+        self.executor.config['profile_dir'] = tempfile.gettempdir()
+        self.executor.config['profile_max_duration'] = 0.1
+
+    def tearDown(self):
+        # do not sample the following tests
+        if self.executor._profiler is not None:
+            self.executor._profiler._thread.join()
+
+    def test_invalid_duration_should_be_refused(self):
+        for argument in ('abc', '-1', '0', 'nan'):
+            self.assertIn('error', self.executor.start_profile(argument))
+
+    def test_duration_should_be_clamped(self):
+        response = self.executor.start_profile('inf')
+
+        self.assertEqual(response['duration'], 0.1)
+
+    def test_concurrent_profile_should_be_refused(self):
+        self.assertIn('path', self.executor.start_profile('0.1'))
+        self.assertIn('error', self.executor.start_profile('0.1'))
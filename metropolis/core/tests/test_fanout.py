@@ -0,0 +1,101 @@
+import asyncio
+import unittest
+
+from nats.aio.client import Msg
+
+from metropolis.core.fanout import FanoutHub
+from metropolis.core.utils import simple_eventloop
+
+
+class FakeNats(object):
+    def __init__(self):
+        self.subscriptions = {}
+        self.error = None
+
+    async def subscribe(self, subject, cb):
+        await asyncio.sleep(0)
+        if self.error:
+            raise self.error
+
+        subscription_id = len(self.subscriptions) + 1
+        self.subscriptions[subscription_id] = cb
+        return subscription_id
+
+    async def unsubscribe(self, subscription_id):
+        del self.subscriptions[subscription_id]
+
+    async def deliver(self, subject, data):
+        for cb in list(self.subscriptions.values()):
+            await cb(Msg(subject=subject, data=data))
+
+
+class FakeDriver(object):
+    def __init__(self):
+        self.nats = FakeNats()
+
+
+class TestFanoutHub(unittest.TestCase):
+    def test_clients_should_share_subscription(self):
+        driver = FakeDriver()
+        hub = FanoutHub(driver, buffer_size=10)
+
+        async def fanout():
+            clients = [await hub.subscribe('foo.events') for _ in range(3)]
+            await driver.nats.deliver('foo.events', b'hello')
+
+            messages = [await client.get() for client in clients]
+            subscriptions = len(driver.nats.subscriptions)
+
+            for client in clients:
+                await hub.unsubscribe(client)
+
+            return messages, subscriptions
+
+        with simple_eventloop() as loop:
+            messages, subscriptions = loop.run_until_complete(fanout())
+
+        self.assertEqual(messages, [b'hello'] * 3)
+        self.assertEqual(subscriptions, 1)
+        self.assertEqual(driver.nats.subscriptions, {})
+        self.assertEqual(hub.client_count, 0)
+
+    def test_slow_client_should_be_closed(self):
+        driver = FakeDriver()
+        hub = FanoutHub(driver, buffer_size=2)
+
+        async def fanout():
+            client = await hub.subscribe('foo.events')
+            for i in range(3):
+                await driver.nats.deliver('foo.events', b'hello')
+
+            return client, await client.get()
+
+        with simple_eventloop() as loop:
+            client, message = loop.run_until_complete(fanout())
+
+        self.assertTrue(client.closed)
+        self.assertIsNone(message)
+
+    def test_failed_subscription_should_close_waiting_clients(self):
+        driver = FakeDriver()
+        driver.nats.error = ConnectionError('disconnected')
+        hub = FanoutHub(driver, buffer_size=10)
+
+        async def fanout():
+            return await asyncio.gather(
+                hub.subscribe('foo.events'), hub.subscribe('foo.events'),
+                return_exceptions=True)
+
+        with simple_eventloop() as loop:
+            first, second = loop.run_until_complete(fanout())
+
+        self.assertIsInstance(first, ConnectionError)
+        self.assertTrue(second.closed)
+        self.assertEqual(hub.client_count, 0)
+
+        driver.nats.error = None
+        with simple_eventloop() as loop:
+            client = loop.run_until_complete(hub.subscribe('foo.events'))
+
+        self.assertFalse(client.closed)
+        self.assertEqual(len(driver.nats.subscriptions), 1)
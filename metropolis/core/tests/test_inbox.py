@@ -0,0 +1,67 @@
+import unittest
+
+from nats.aio.client import Msg
+from nats.aio.errors import ErrTimeout
+
+from metropolis.core.inbox import InboxFullError
+from metropolis.core.inbox import ReplyInbox
+from metropolis.core.utils import simple_eventloop
+
+
+class EchoNats(object):
+    """Fake connection replying the payload back to the inbox
+    """
+
+    def __init__(self, reply=True):
+        self.reply = reply
+        self.subscriptions = []
+        self.cb = None
+
+    async def subscribe(self, subject, cb):
+        self.subscriptions.append(subject)
+        self.cb = cb
+        return len(self.subscriptions)
+
+    async def publish_request(self, subject, reply, payload):
+        if self.reply:
+            await self.cb(Msg(subject=reply, data=payload))
+
+
+class TestReplyInbox(unittest.TestCase):
+    def test_replies_should_be_routed_by_token(self):
+        nats = EchoNats()
+        inbox = ReplyInbox(nats, max_pending=10)
+
+        async def request():
+            await inbox.start()
+            return [
+                (await inbox.request('foo.get', f'{i}'.encode(), timeout=1)).data
+                for i in range(3)
+            ]
+
+        with simple_eventloop() as loop:
+            replies = loop.run_until_complete(request())
+
+        self.assertEqual(replies, [b'0', b'1', b'2'])
+        self.assertEqual(len(nats.subscriptions), 1)
+        self.assertEqual(inbox.pending_count, 0)
+
+    def test_timed_out_request_should_be_cleaned_up(self):
+        inbox = ReplyInbox(EchoNats(reply=False), max_pending=10)
+
+        async def request():
+            await inbox.start()
+            await inbox.request('foo.get', b'', timeout=0.01)
+
+        with simple_eventloop() as loop:
+            with self.assertRaises(ErrTimeout):
+                loop.run_until_complete(request())
+
+        self.assertEqual(inbox.pending_count, 0)
+
+    def test_pending_requests_should_be_bounded(self):
+        inbox = ReplyInbox(EchoNats(reply=False), max_pending=0)
+
+        with simple_eventloop() as loop:
+            with self.assertRaises(InboxFullError):
+                loop.run_until_complete(inbox.request('foo.get', b'', timeout=1))
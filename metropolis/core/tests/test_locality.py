@@ -0,0 +1,47 @@
+import time
+import unittest
+
+from nats.aio.client import Msg
+
+from metropolis.core.locality import LOCALITY_SUBJECT_JOIN
+from metropolis.core.locality import LOCALITY_SUBJECT_LEAVE
+from metropolis.core.locality import LocalityRouter
+from metropolis.core.locality import encode_announcement
+from metropolis.core.utils import simple_eventloop
+
+
+class TestLocalityRouter(unittest.TestCase):
+    def test_global_subject_should_be_used_without_replicas(self):
+        router = LocalityRouter(scopes=('node-1', 'zone-a'), ttl=10)
+
+        self.assertEqual(list(router.candidates('foo.get')), ['foo.get'])
+
+    def test_nearest_scope_should_be_preferred(self):
+        router = LocalityRouter(scopes=('node-1', 'zone-a'), ttl=10)
+        router.join('replica-1', ['foo.get.zone-a'])
+        router.join('replica-2', ['foo.get.node-1', 'foo.get.zone-a'])
+
+        self.assertEqual(
+            list(router.candidates('foo.get')),
+            ['foo.get.node-1', 'foo.get.zone-a', 'foo.get'])
+
+    def test_replica_should_be_expired(self):
+        router = LocalityRouter(scopes=('node-1',), ttl=0.01)
+        router.join('replica-1', ['foo.get.node-1'])
+        time.sleep(0.02)
+
+        self.assertEqual(list(router.candidates('foo.get')), ['foo.get'])
+
+    def test_announcements_should_update_replicas(self):
+        router = LocalityRouter(scopes=('node-1',), ttl=10)
+        announcement = encode_announcement('replica-1', ['foo.get.node-1'])
+
+        with simple_eventloop() as loop:
+            loop.run_until_complete(router.handle_announcement(
+                Msg(subject=LOCALITY_SUBJECT_JOIN, data=announcement)))
+            self.assertEqual(
+                list(router.candidates('foo.get')), ['foo.get.node-1', 'foo.get'])
+
+            loop.run_until_complete(router.handle_announcement(
+                Msg(subject=LOCALITY_SUBJECT_LEAVE, data=announcement)))
+            self.assertEqual(list(router.candidates('foo.get')), ['foo.get'])
@@ -0,0 +1,59 @@
+import unittest
+
+from metropolis.core.partition import HashRing
+from metropolis.core.partition import PartitionTable
+from metropolis.core.partition import partition_of
+
+
+class TestHashRing(unittest.TestCase):
+    def test_partition_should_be_stable(self):
+        self.assertEqual(partition_of('user-1', 64), partition_of('user-1', 64))
+
+    def test_joining_member_should_take_over_only_its_partitions(self):
+        before = HashRing(['replica-1', 'replica-2', 'replica-3'])
+        after = HashRing(['replica-1', 'replica-2', 'replica-3', 'replica-4'])
+
+        moved = [p for p in range(256) if before.owner(p) != after.owner(p)]
+
+        self.assertTrue(moved)
+        self.assertTrue(all(after.owner(p) == 'replica-4' for p in moved))
+
+    def test_empty_ring_should_not_have_owner(self):
+        self.assertIsNone(HashRing([]).owner(0))
+
+
+class TestPartitionTable(unittest.TestCase):
+    def test_partitions_should_be_claimed_by_members(self):
+        table = PartitionTable(ttl=10)
+        table.join('replica-1', 'user.get', 'user_id', 16)
+        table.join('replica-2', 'user.get', 'user_id', 16)
+
+        owned_1 = table.owned_partitions('user.get', 'replica-1')
+        owned_2 = table.owned_partitions('user.get', 'replica-2')
+
+        self.assertEqual(owned_1 | owned_2, set(range(16)))
+        self.assertFalse(owned_1 & owned_2)
+
+    def test_message_should_be_routed_by_key(self):
+        table = PartitionTable(ttl=10)
+        table.join('replica-1', 'user.get', 'user_id', 16)
+
+        subject = table.route('user.get', {'user_id': ['alice']})
+
+        self.assertEqual(subject, f'user.get.p{partition_of("alice", 16)}')
+        self.assertEqual(table.resolve('user.get', 'alice'), subject)
+        self.assertEqual(table.route('foo.get', {'user_id': ['alice']}), 'foo.get')
+
+    def test_global_subject_should_be_used_without_members(self):
+        table = PartitionTable(ttl=10)
+        changes = []
+        table.on_change = changes.append
+
+        table.join('replica-1', 'user.get', 'user_id', 16)
+        self.assertTrue(table.is_partitioned('user.get'))
+
+        table.leave('replica-1', 'user.get')
+        self.assertFalse(table.is_partitioned('user.get'))
+
+        self.assertEqual(changes, ['user.get', 'user.get'])
+        self.assertEqual(table.resolve('user.get', 'alice'), 'user.get')
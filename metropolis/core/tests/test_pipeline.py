@@ -0,0 +1,117 @@
+import unittest
+
+from nats.aio.client import Msg
+
+from metropolis.core.driver import NatsDriver
+from metropolis.core.pipeline import EnvelopeError
+from metropolis.core.pipeline import create_envelope
+from metropolis.core.pipeline import normalize_stages
+from metropolis.core.pipeline import open_envelope
+from metropolis.core.serializer import JsonMessageSerializer
+from metropolis.core.utils import simple_eventloop
+
+
+def add_one(number):
+    return {'number': number + 1}
+
+
+def fail(number):
+    raise ValueError('failed')
+
+
+class RecordingNats(object):
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, subject, payload):
+        self.published.append((subject, JsonMessageSerializer.deserialize(payload)))
+
+
+class TestPipelineEnvelope(unittest.TestCase):
+    def test_envelope_should_carry_remaining_stages(self):
+        stages = normalize_stages(['a.post', ('b.post', 5)], default_timeout=30)
+        subject, envelope = create_envelope(stages, '_INBOX.1', {'number': 1})
+        pipeline, data = open_envelope(envelope)
+
+        self.assertEqual(subject, '_metropolis.stage.a.post')
+        self.assertEqual(pipeline['stages'], [['b.post', 5]])
+        self.assertEqual(pipeline['reply'], '_INBOX.1')
+        self.assertEqual(data, {'number': 1})
+
+    def test_malformed_envelope_should_be_refused(self):
+        messages = [
+            {'number': 1},
+            {'__pipeline__': ['x'], 'data': ['y']},
+            {'__pipeline__': 'x'},
+            {'__pipeline__': {'stages': [['a.post']], 'reply': '', 'deadline': 0}, 'data': {}},
+            {'__pipeline__': {'stages': [], 'reply': None, 'deadline': 0}, 'data': {}},
+            {'__pipeline__': {'stages': [], 'reply': '', 'deadline': '0'}, 'data': {}},
+        ]
+
+        for message in messages:
+            with self.assertRaises(EnvelopeError):
+                open_envelope(message)
+
+
+class TestDriverPipeline(unittest.TestCase):
+    def setUp(self):
+        self.driver = NatsDriver(['nats://localhost:4222'], JsonMessageSerializer)
+        self.driver.nats = RecordingNats()
+
+    def run_pipeline(self, stages, local_tasks):
+        handler = self.driver.create_pipeline(
+            normalize_stages(stages, default_timeout=30), local_tasks)
+        msg = Msg(subject='p.post', reply='_INBOX.1', data=b'{"number": 1}')
+
+        with simple_eventloop() as loop:
+            loop.run_until_complete(handler(msg))
+
+        return self.driver.nats.published
+
+    def test_output_should_be_forwarded_to_next_stage(self):
+        published = self.run_pipeline(['a.post', 'b.post'], {'a.post': (add_one, None)})
+
+        self.assertEqual(len(published), 1)
+        subject, envelope = published[0]
+        pipeline, data = open_envelope(envelope)
+
+        self.assertEqual(subject, '_metropolis.stage.b.post')
+        self.assertEqual(pipeline['reply'], '_INBOX.1')
+        self.assertEqual(data, {'number': 2})
+
+    def test_last_stage_should_reply_to_caller(self):
+        published = self.run_pipeline(['a.post'], {'a.post': (add_one, None)})
+
+        self.assertEqual(published, [('_INBOX.1', {'code': 200, 'data': {'number': 2}})])
+
+    def test_failed_stage_should_short_circuit(self):
+        published = self.run_pipeline(['a.post', 'b.post'], {'a.post': (fail, None)})
+
+        self.assertEqual(published, [('_INBOX.1', {'code': 500, 'data': 'failed'})])
+
+    def test_expired_stage_should_not_be_executed(self):
+        published = self.run_pipeline([('a.post', -1), 'b.post'], {'a.post': (add_one, None)})
+
+        self.assertEqual(published[0][1]['code'], 504)
+
+    def test_malformed_envelope_should_be_replied_with_400(self):
+        handler = self.driver.create_task_simple(add_one, stage=True)
+        msg = Msg(
+            subject='_metropolis.stage.a.post', reply='_INBOX.1',
+            data=b'{"__pipeline__": ["x"], "data": ["y"]}')
+
+        with simple_eventloop() as loop:
+            loop.run_until_complete(handler(msg))
+
+        self.assertEqual(self.driver.nats.published[0][1]['code'], 400)
+
+    def test_envelope_should_not_be_opened_on_task_subject(self):
+        handler = self.driver.create_task_simple(add_one)
+        msg = Msg(
+            subject='a.post', reply='_INBOX.1',
+            data=b'{"__pipeline__": {"stages": [], "reply": "evil", "deadline": 0}, "data": {}}')
+
+        with simple_eventloop() as loop:
+            loop.run_until_complete(handler(msg))
+
+        self.assertEqual([subject for subject, _ in self.driver.nats.published], ['_INBOX.1'])
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from metropolis.core.driver import NatsDriver
+from metropolis.core.profiler import LoopLagMonitor
+from metropolis.core.profiler import SamplingProfiler
+from metropolis.core.serializer import JsonMessageSerializer
+from metropolis.core.utils import simple_eventloop
+
+
+def busy_loop(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+class TestLoopLagMonitor(unittest.TestCase):
+    def test_blocking_execution_should_be_reported(self):
+        driver = NatsDriver(['nats://localhost:4222'], JsonMessageSerializer)
+
+        async def block_loop(monitor):
+            monitor.start()
+            await asyncio.sleep(0.05)
+
+            busy_loop(0.2)
+            driver._record_execution('foo.get', 'busy_loop', 0.2)
+            await asyncio.sleep(0.1)
+
+            monitor.stop()
+
+        with simple_eventloop() as loop:
+            monitor = LoopLagMonitor(loop, driver, interval=0.05, threshold=0.1)
+            with self.assertLogs(level='WARNING') as logs:
+                loop.run_until_complete(block_loop(monitor))
+
+        self.assertIn('[subject=foo.get][fn=busy_loop]', logs.output[0])
+        self.assertIsNone(driver.pop_slowest_execution())
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def test_profiler_should_sample_target_thread(self):
+        profiler = SamplingProfiler('.', 'test', interval=0.001)
+        thread = threading.Thread(target=busy_loop, args=(0.2,))
+        thread.start()
+        profiler.thread_id = thread.ident
+
+        samples = profiler.sample(0.1)
+        thread.join()
+
+        self.assertTrue(samples)
+        self.assertTrue(all('busy_loop' in stack for stack in samples))
@@ -0,0 +1,89 @@
+import json
+import unittest
+
+from metropolis.core.locality import ReplicaTable
+from metropolis.core.ratelimit import ADMISSION_CLIENT_LIMITED
+from metropolis.core.ratelimit import ADMISSION_CONCURRENCY_LIMITED
+from metropolis.core.ratelimit import ADMISSION_ROUTE_LIMITED
+from metropolis.core.ratelimit import AdmissionController
+from metropolis.core.ratelimit import TokenBucketTable
+
+
+class TestTokenBucketTable(unittest.TestCase):
+    def test_tokens_should_be_refilled_by_rate(self):
+        table = TokenBucketTable(rate=10, burst=2)
+
+        self.assertTrue(table.consume('foo', now=0))
+        self.assertTrue(table.consume('foo', now=0))
+        self.assertFalse(table.consume('foo', now=0))
+        self.assertTrue(table.consume('foo', now=0.1))
+
+    def test_table_should_be_bounded(self):
+        table = TokenBucketTable(rate=1, burst=1, max_keys=2)
+
+        for key in ('a', 'b', 'c'):
+            table.consume(key, now=0)
+
+        self.assertEqual(len(table), 2)
+
+    def test_idle_buckets_should_be_evicted(self):
+        table = TokenBucketTable(rate=1, burst=1, idle_timeout=10)
+        table.consume('a', now=0)
+        table.consume('b', now=5)
+
+        table.consume('c', now=12)
+
+        self.assertEqual(len(table), 2)
+
+
+class TestAdmissionController(unittest.TestCase):
+    def test_route_should_be_limited(self):
+        admission = AdmissionController('gateway-1', route_limit=(1, 1))
+
+        self.assertIsNone(admission.admit('foo.get', '10.0.0.1'))
+        self.assertEqual(admission.admit('foo.get', '10.0.0.2'), ADMISSION_ROUTE_LIMITED)
+
+    def test_rejected_request_should_not_consume_route_tokens(self):
+        admission = AdmissionController(
+            'gateway-1', route_limit=(0.001, 2), client_limit=(0.001, 1))
+
+        self.assertIsNone(admission.admit('foo.get', '10.0.0.1'))
+        self.assertEqual(admission.admit('foo.get', '10.0.0.1'), ADMISSION_CLIENT_LIMITED)
+        self.assertIsNone(admission.admit('foo.get', '10.0.0.2'))
+
+    def test_consumption_of_other_gateways_should_be_applied(self):
+        admission = AdmissionController('gateway-1', client_limit=(0.001, 2))
+        other = AdmissionController('gateway-2', client_limit=(0.001, 2))
+
+        self.assertIsNone(admission.admit('foo.get', '10.0.0.1'))
+        other.admit('foo.get', '10.0.0.1')
+        for payload in other.sync_payloads():
+            admission.apply_sync(payload)
+
+        self.assertIsNotNone(admission.admit('foo.get', '10.0.0.1'))
+
+    def test_sync_payloads_should_be_bounded(self):
+        admission = AdmissionController('gateway-1', client_limit=(1, 1))
+        for i in range(1000):
+            admission.admit('foo.get', f'10.0.{i // 256}.{i % 256}')
+
+        payloads = admission.sync_payloads(max_size=4096)
+
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(payload) <= 4096 + 64 for payload in payloads))
+        self.assertEqual(
+            sum(len(json.loads(payload)['clients']) for payload in payloads), 1000)
+        self.assertEqual(admission.sync_payloads(), [])
+
+    def test_concurrency_should_be_capped_by_replicas(self):
+        replicas = ReplicaTable(ttl=10)
+        replicas.join('worker-1', ['foo.get'])
+        admission = AdmissionController(
+            'gateway-1', concurrency_per_replica=1, replicas=replicas)
+
+        self.assertIsNone(admission.admit('foo.get', '10.0.0.1'))
+        self.assertEqual(
+            admission.admit('foo.get', '10.0.0.1'), ADMISSION_CONCURRENCY_LIMITED)
+
+        admission.release('foo.get')
+        self.assertIsNone(admission.admit('foo.get', '10.0.0.1'))
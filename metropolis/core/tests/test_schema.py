@@ -0,0 +1,101 @@
+import asyncio
+import unittest
+from typing import List
+from typing import Optional
+
+from metropolis.core.schema import SchemaRegistry
+from metropolis.core.schema import TaskSchema
+from metropolis.core.schema import ValidationError
+from metropolis.core.serializer import JsonMessageSerializer
+from metropolis.core.utils import simple_eventloop
+
+
+def get_user(user_id: int, verbose: bool = False, tags: Optional[List[str]] = None):
+    return user_id
+
+
+def mytask(data, *args, **kwargs):
+    return data
+
+
+class Response(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class SchemaDriver(object):
+    serializer = JsonMessageSerializer
+
+    def __init__(self):
+        self.requests = []
+
+    async def request(self, subject, payload, timeout):
+        self.requests.append(subject)
+        await asyncio.sleep(0.01)
+
+        return Response(JsonMessageSerializer.serialize(
+            TaskSchema.from_function(get_user).describe()))
+
+
+class TestTaskSchema(unittest.TestCase):
+    def test_args_should_be_converted_by_type_hints(self):
+        schema = TaskSchema.from_function(get_user)
+
+        kwargs = schema.bind({'user_id': ['3'], 'verbose': ['true'], 'tags': 'a'})
+
+        self.assertEqual(kwargs, {'user_id': 3, 'verbose': True, 'tags': ['a']})
+
+    def test_invalid_args_should_be_rejected(self):
+        schema = TaskSchema.from_function(get_user)
+
+        with self.assertRaises(ValidationError) as context:
+            schema.bind({'user_id': 'abc', 'name': 'alice'})
+
+        self.assertEqual(
+            str(context.exception), 'user_id: invalid value, name: unknown argument')
+
+    def test_routing_params_should_be_dropped(self):
+        schema = TaskSchema.from_function(get_user)
+
+        self.assertEqual(schema.bind({'user_id': 1, '_worker': 'a'}), {'user_id': 1})
+
+    def test_extra_args_should_be_passed(self):
+        schema = TaskSchema.from_function(mytask)
+
+        kwargs = schema.bind({'data': ['hello'], '_worker': ['a']})
+
+        self.assertEqual(kwargs, {'data': ['hello'], '_worker': ['a']})
+
+    def test_explicit_schema(self):
+        schema = TaskSchema.from_dict({'user_id': int, 'name': Optional[str]})
+
+        self.assertEqual(schema.bind({'user_id': '1'}), {'user_id': 1})
+        with self.assertRaises(ValidationError):
+            schema.bind({'name': 'alice'})
+
+    def test_described_schema_should_validate_presence(self):
+        schema = TaskSchema.from_description(
+            TaskSchema.from_function(get_user).describe())
+
+        schema.validate({'user_id': ['1']})
+        with self.assertRaises(ValidationError):
+            schema.validate({'verbose': ['1']})
+
+
+class TestSchemaRegistry(unittest.TestCase):
+    def test_schema_should_be_fetched_once_in_background(self):
+        driver = SchemaDriver()
+        registry = SchemaRegistry(driver, timeout=1)
+
+        async def get_schemas():
+            loading = [registry.get('user.get') for _ in range(3)]
+            await asyncio.sleep(0.05)
+
+            return loading, registry.get('user.get')
+
+        with simple_eventloop() as loop:
+            loading, schema = loop.run_until_complete(get_schemas())
+
+        self.assertEqual(loading, [None] * 3)
+        self.assertIsNotNone(schema)
+        self.assertEqual(driver.requests, ['_metropolis.schema.user.get'])
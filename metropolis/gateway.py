@@ -1,19 +1,69 @@
+import asyncio
+import logging
+import signal
+from contextlib import suppress
+
 from sanic import Sanic
 from sanic.response import json
+from sanic.response import stream
 
 from metropolis.core.executor import Executor
+from metropolis.core.executor import EXECUTOR_STATE_READY
+from metropolis.core.executor import EXECUTOR_STATE_DRAINING
+from metropolis.core.executor import EXECUTOR_STATE_STOPPED
+from metropolis.core.fanout import FanoutHub
+from metropolis.core.locality import REPLICA_SUBJECT
+from metropolis.core.locality import ReplicaTable
+from metropolis.core.ratelimit import ADMISSION_REASONS
+from metropolis.core.ratelimit import RATE_LIMIT_SUBJECT
+from metropolis.core.ratelimit import AdmissionController
+from metropolis.core.schema import SchemaRegistry
+from metropolis.core.schema import ValidationError
+
+
+def encode_sse_event(data):
+    """Encode message to `text/event-stream` event
+    """
+
+    return b''.join(b'data: ' + line + b'\n' for line in data.split(b'\n')) + b'\n'
 
 
 class Gateway(Executor):
     app = None
     nats = None
+    _loop_monitor = None
+    _admission = None
+    _admission_sync = None
 
     def __init__(self, name, config):
         super(Gateway, self).__init__(name, config)
 
         self.app = Sanic()
         self.app.listener('before_server_start')(self.setup)
+        self.app.listener('after_server_start')(self.start_signal_handlers)
+        self.app.listener('before_server_stop')(self.drain)
+        self.app.listener('after_server_stop')(self.teardown)
+        self.app.route('/_health/', methods=['GET'])(self.get_health)
         self.app.route('/_routes/', methods=['GET'])(self.get_routes)
+
+        self._fanout = FanoutHub(self._driver, self.config['fanout_buffer_size'])
+        self._schemas = SchemaRegistry(self._driver, timeout=self.config['request_timeout'])
+        self._replicas = ReplicaTable(ttl=self.config['heartbeat_interval'] * 3)
+        if self.config['rate_limit_route'] or self.config['rate_limit_client'] \
+                or self.config['concurrency_per_replica']:
+            self._admission = AdmissionController(
+                self.replica_id,
+                route_limit=self.config['rate_limit_route'],
+                client_limit=self.config['rate_limit_client'],
+                concurrency_per_replica=self.config['concurrency_per_replica'],
+                replicas=self._replicas,
+                max_keys=self.config['rate_limit_max_keys'],
+                idle_timeout=self.config['rate_limit_idle_timeout'])
+
+        if self.config['fanout_enabled']:
+            self.app.websocket('/_ws/<path:[^/].*?>')(self.subscribe_websocket)
+            self.app.route('/_sse/<path:[^/].*?>', methods=['GET'])(self.subscribe_sse)
+
         self.app.route('/<path:[^/].*?>', methods=['GET'])(self.resolve_message)
 
     async def setup(self, app, loop):
@@ -22,6 +72,103 @@ class Gateway(Executor):
 
         self.nats = await self._driver.get_connection(loop)
 
+        if self.config['control_lifecycle']:
+            await self.nats.subscribe(self.name, cb=self.handle_control)
+
+        await self.start_locality(self.nats)
+        await self.start_partitions(self.nats)
+
+        if self._admission:
+            await self.start_admission(self.nats, loop)
+
+        self._loop_monitor = self.start_loop_monitor(loop)
+        self.set_state(EXECUTOR_STATE_READY)
+
+    async def start_signal_handlers(self, app, loop):
+        """ Replace stop signal handlers of sanic, which stop the server
+        without a draining period
+
+        Sanic registers its handlers after this listener, so ours are set
+        once the eventloop runs.
+        """
+
+        loop.call_soon(self._set_signal_handlers, loop)
+
+    def _set_signal_handlers(self, loop):
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            with suppress(NotImplementedError):
+                loop.add_signal_handler(stop_signal, self.begin_drain, loop)
+
+    def begin_drain(self, loop):
+        """ Report not ready, and keep serving for `DRAIN_DELAY` seconds so
+        that ingress stops routing new requests before the listener closes
+
+        Another stop signal while draining stops the server immediately.
+        """
+
+        if self.state == EXECUTOR_STATE_DRAINING:
+            loop.stop()
+            return
+
+        self.set_state(EXECUTOR_STATE_DRAINING)
+        loop.call_later(self.config['drain_delay'], loop.stop)
+
+    async def drain(self, app, loop):
+        """ Finish draining when the server is stopped without stop signal
+        """
+
+        self.set_state(EXECUTOR_STATE_DRAINING)
+
+        # finish streaming responses, server waits for them on shutdown
+        self._fanout.close()
+
+    async def teardown(self, app, loop):
+        """ Close nats connection after in-flight http requests are done
+        """
+
+        if self._loop_monitor:
+            self._loop_monitor.stop()
+
+        if self._admission_sync:
+            self._admission_sync.cancel()
+
+        await self._driver.close()
+        self.set_state(EXECUTOR_STATE_STOPPED)
+
+    async def start_admission(self, nats, loop):
+        if self.config['concurrency_per_replica']:
+            await nats.subscribe(
+                f'{REPLICA_SUBJECT}.*', cb=self._replicas.handle_announcement)
+
+        if self.config['rate_limit_sync_interval']:
+            await nats.subscribe(RATE_LIMIT_SUBJECT, cb=self._admission.handle_sync)
+            self._admission_sync = loop.create_task(self._sync_admission(nats))
+
+    async def _sync_admission(self, nats):
+        """Share consumed tokens, so that limits are applied cluster-wide
+        """
+
+        while True:
+            await asyncio.sleep(self.config['rate_limit_sync_interval'])
+
+            for payload in self._admission.sync_payloads():
+                try:
+                    await nats.publish(RATE_LIMIT_SUBJECT, payload)
+
+                except asyncio.CancelledError:
+                    raise
+
+                except Exception as e:
+                    logging.warning(f'Rate limit sync is failed [error={e}]')
+
+    def get_client_key(self, request):
+        header = self.config['rate_limit_client_header']
+        if header and header in request.headers:
+            # first address of `X-Forwarded-For` is the client
+            return request.headers[header].split(',')[0].strip()
+
+        return request.ip
+
     def serialize_request_to_nats_message(self, request, path: str) -> (str, str):
         """Resolve path to nats topic, messages
 
@@ -29,6 +176,9 @@ class Gateway(Executor):
         - topic: {path.replace('/', '.'}.{method}.{param['_worker']}
         - message: GET params | POST body
 
+        Without `_worker` param, the same node/zone replica is preferred
+        by the locality router.
+
         :Params
             - request: sanic request
             - path <str>: path of url
@@ -45,6 +195,94 @@ class Gateway(Executor):
 
         return (nats_route, request.args)
 
+    @staticmethod
+    def get_task_subject(route, body):
+        """Returns subject of route without `_worker` suffix
+        """
+
+        worker = body.get('_worker')
+        if isinstance(worker, list):
+            worker = worker[0] if worker else None
+
+        if worker and route.endswith(f'.{worker}'):
+            return route[:-len(worker) - 1]
+
+        return route
+
+    def serialize_path_to_nats_subject(self, path: str) -> str:
+        """Resolve path to publish subject of fan-out streams
+
+        Wildcards and internal subjects (`_INBOX`, `_metropolis`, ...)
+        are not allowed.
+
+        :Returns
+            <str>: subject, None if the subject is not allowed
+        """
+
+        subject = path.strip('/').replace('/', '.')
+
+        for token in subject.split('.'):
+            if not token or token[0] == '_' or token in ('*', '>'):
+                return None
+
+        return subject
+
+    async def subscribe_websocket(self, request, ws, path: str):
+        subject = self.serialize_path_to_nats_subject(path)
+        if subject is None:
+            return
+
+        client = await self._fanout.subscribe(subject)
+
+        async def wait_closed():
+            # inbound messages are ignored
+            with suppress(Exception):
+                while True:
+                    await ws.recv()
+
+            client.close()
+
+        receiver = asyncio.ensure_future(wait_closed())
+
+        try:
+            while True:
+                data = await client.get()
+                if data is None:
+                    break
+
+                await ws.send(data.decode())
+
+        finally:
+            receiver.cancel()
+            await self._fanout.unsubscribe(client)
+
+    async def subscribe_sse(self, request, path: str):
+        subject = self.serialize_path_to_nats_subject(path)
+        if subject is None:
+            return json({'error': 'subject is not allowed'}, status=400)
+
+        async def stream_events(response):
+            client = await self._fanout.subscribe(subject)
+
+            try:
+                while True:
+                    data = await client.get()
+                    if data is None:
+                        break
+
+                    await response.write(encode_sse_event(data))
+
+            finally:
+                await self._fanout.unsubscribe(client)
+
+        return stream(
+            stream_events,
+            content_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache'})
+
+    async def get_health(self, request):
+        return json({'state': self.state}, status=200 if self.is_ready else 503)
+
     async def get_routes(self, request):
         # TODO: Returns routemap from nats 'routez'
         self.nats
@@ -53,9 +291,36 @@ class Gateway(Executor):
     async def resolve_message(self, request, path: str):
         (route, body) = self.serialize_request_to_nats_message(request, path)
 
+        if not self._admission:
+            return await self._resolve_message(route, body)
+
+        # reject excess load at the edge, before it reaches workers
+        rejected = self._admission.admit(route, self.get_client_key(request))
+        if rejected:
+            return json(ADMISSION_REASONS[rejected], status=rejected)
+
+        try:
+            return await self._resolve_message(route, body)
+        finally:
+            self._admission.release(route)
+
+    async def _resolve_message(self, route, body):
+        # reject invalid request at the edge, before a nats round trip
+        if self.config['schema_validation']:
+            schema = self._schemas.get(self.get_task_subject(route, body))
+
+            try:
+                if schema:
+                    schema.validate(body)
+            except ValidationError as e:
+                return json(str(e), status=400)
+
+        route = self._partitions.route(route, body)
+
         # data transport
         message = self._driver.serializer.serialize(body)
-        worker_response = await self.nats.request(route, message)
+        worker_response = await self.route_request(
+            route, message, timeout=self.config['request_timeout'])
 
         worker_response_dict = self._driver.serializer.deserialize(
             worker_response.data)
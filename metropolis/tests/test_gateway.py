@@ -1,6 +1,21 @@
 import unittest
 
+from metropolis import Gateway
 from metropolis import Worker
+from metropolis.core.executor import EXECUTOR_STATE_DRAINING
+
+
+class FakeLoop(object):
+    stopped = False
+
+    def __init__(self):
+        self.scheduled = []
+
+    def call_later(self, delay, callback):
+        self.scheduled.append((delay, callback))
+
+    def stop(self):
+        self.stopped = True
 
 
 class TestWorker(unittest.TestCase):
@@ -12,3 +27,35 @@ class TestWorker(unittest.TestCase):
         self.assertEqual(
             worker.config['serializer_class'],
             'metropolis.core.serializer.DefaultMessageSerializer')
+
+
+class TestGateway(unittest.TestCase):
+    def test_path_should_be_resolved_to_subject(self):
+        gateway = Gateway('test-gateway', None)
+
+        self.assertEqual(
+            gateway.serialize_path_to_nats_subject('foo/events'), 'foo.events')
+
+    def test_internal_subject_should_not_be_resolved(self):
+        gateway = Gateway('test-gateway', None)
+
+        self.assertIsNone(gateway.serialize_path_to_nats_subject('_INBOX/foo'))
+        self.assertIsNone(gateway.serialize_path_to_nats_subject('foo/>'))
+
+    def test_task_subject_should_not_have_worker_suffix(self):
+        self.assertEqual(
+            Gateway.get_task_subject('foo.get.node1', {'_worker': ['node1']}), 'foo.get')
+        self.assertEqual(Gateway.get_task_subject('foo.get', {}), 'foo.get')
+
+    def test_stop_signal_should_drain_before_stopping(self):
+        gateway = Gateway('test-gateway', None)
+        loop = FakeLoop()
+
+        gateway.begin_drain(loop)
+
+        self.assertEqual(gateway.state, EXECUTOR_STATE_DRAINING)
+        self.assertEqual(loop.scheduled, [(gateway.config['drain_delay'], loop.stop)])
+        self.assertFalse(loop.stopped)
+
+        gateway.begin_drain(loop)
+        self.assertTrue(loop.stopped)
@@ -1,23 +1,42 @@
 import asyncio
 import logging
 import signal
-import sys
+import time
 from contextlib import asynccontextmanager
-from contextlib import suppress
 
 import uvloop
 
 from metropolis.core.utils import get_module
 from metropolis.core.executor import Executor
-from metropolis.core.driver import WORKER_STATE_CONNECTED
+from metropolis.core.executor import EXECUTOR_STATE_READY
+from metropolis.core.executor import EXECUTOR_STATE_STARTING
+from metropolis.core.executor import EXECUTOR_STATE_DRAINING
+from metropolis.core.executor import EXECUTOR_STATE_STOPPED
+from metropolis.core.locality import LOCALITY_SUBJECT_JOIN
+from metropolis.core.locality import LOCALITY_SUBJECT_LEAVE
+from metropolis.core.locality import REPLICA_SUBJECT_JOIN
+from metropolis.core.locality import REPLICA_SUBJECT_LEAVE
+from metropolis.core.locality import encode_announcement
+from metropolis.core.locality import scoped_subject
+from metropolis.core.pipeline import normalize_stages
+from metropolis.core.pipeline import stage_subject
+from metropolis.core.schema import SCHEMA_SUBJECT
+from metropolis.core.schema import TaskSchema
+from metropolis.core.partition import PARTITION_SUBJECT_JOIN
+from metropolis.core.partition import PARTITION_SUBJECT_LEAVE
+from metropolis.core.partition import partition_subject
+from metropolis.core.partition import encode_announcement as encode_partition_announcement
 
 
 # Worker constants
 WORKER_CONTROL_SIGNAL_START = '__START__'
 WORKER_CONTROL_SIGNAL_STOP = '__STOP__'
+WORKER_CONTROL_SIGNAL_STATUS = '__STATUS__'
 
 WORKER_TASK_TIMEOUT = 30
-WORKER_PENDING_AIOTASK_TIMEOUT = 10
+
+# interval of checking partition members of standalone requests (sec)
+PARTITION_POLL_INTERVAL = 0.05
 
 # Default configurations
 DEFAULT_LOG_LEVEL = 'WARNING'
@@ -48,6 +67,15 @@ class Worker(Executor):
 
     # worker tasks
     _tasks = []
+    _subscription_ids = None
+    _scoped_subjects = None
+    _partitioned_tasks = None
+    _partition_subscription_ids = None
+
+    # monotonic deadline of graceful shutdown
+    _drain_deadline = None
+    _stop_requested = False
+    _partitions_joined = False
 
     def __init__(self, name, config=None):
         """ Initialize worker
@@ -81,17 +109,25 @@ class Worker(Executor):
 
     def stop(self, *args, **kwargs):
         """Send stop signal to worker lifecycle handler queue
+
+        This is also a signal handler, so it only schedules draining on the
+        running eventloop and never blocks on it.
         """
 
-        try:
-            if self._driver.state == WORKER_STATE_CONNECTED:
-                logging.debug(f'Send stop signal [signal={WORKER_CONTROL_SIGNAL_STOP}]')
-                self._queue.put_nowait(WORKER_CONTROL_SIGNAL_STOP)
-            else:
-                self._finalize()
+        if self.state == EXECUTOR_STATE_DRAINING:
+            logging.warning('Worker is already draining')
+
+        elif self.state in (EXECUTOR_STATE_STARTING, EXECUTOR_STATE_READY) and self._loop.is_running():
+            # starting worker drains right after startup instead of serving
+            self._stop_requested = True
 
-        except Exception:
-            sys.exit(255)
+            logging.debug(f'Send stop signal [signal={WORKER_CONTROL_SIGNAL_STOP}]')
+            self._loop.call_soon_threadsafe(
+                self._queue.put_nowait, WORKER_CONTROL_SIGNAL_STOP)
+
+        else:
+            # worker is not serving, nothing to drain
+            raise KeyboardInterrupt
 
     def create_signal_handler(self):
         """Return nats message handler function stopping worker.
@@ -101,7 +137,19 @@ class Worker(Executor):
             worker_message = msg.data.decode()
             logging.debug(f'Got worker signal [signal={worker_message}]')
 
-            await self._queue.put_nowait(worker_message)
+            if await self.handle_control(msg):
+                return
+
+            if worker_message == WORKER_CONTROL_SIGNAL_STATUS:
+                if msg.reply:
+                    await self._driver.nats.publish(
+                        msg.reply, self._driver.serializer.serialize({
+                            'state': self.state,
+                            'pending': self._driver.pending_count
+                        }))
+                return
+
+            self._queue.put_nowait(worker_message)
         return _handle_signal
 
     @property
@@ -117,26 +165,59 @@ class Worker(Executor):
         # Gracefully unsubscribe the subscription
         await self._driver.close()
 
-    def task(self, subject, queue):
+    def task(self, subject, queue, partition_key=None, schema=None):
         """Register task decorator
 
+        Messages of task with `partition_key` are routed by the key value to
+        the replica owning its partition, e.g. `foo.get.p12`
+
+        Message data is bound to task args by `schema` before the task runs,
+        invalid messages are replied with code 400. Schema is derived from
+        type hints of the task unless it is given as `{name: type}`.
+
         Example:
             @worker.task(subject='foo.get', queue='worker')
             def mytask(data, *args, **kwargs):
                 return data[0][::-1]
+
+            @worker.task(subject='user.get', queue='worker', partition_key='user_id')
+            def get_user(user_id, *args, **kwargs):
+                return cache[user_id]
         """
 
         def worker_task(task_fn):
             self.config['tasks'].append({
                 'subject': subject,
                 'queue': queue,
-                'task': task_fn
+                'task': task_fn,
+                'partition_key': partition_key,
+                'schema': self._compile_schema(task_fn, schema)
             })
 
             return task_fn
 
         return worker_task
 
+    def pipeline(self, subject, queue, stages):
+        """Register pipeline of tasks
+
+        Each stage forwards its output to the next stage directly, and only
+        the last stage replies to the caller. Failed or timed out stage
+        replies the error instead. Stages are subjects of registered tasks,
+        optionally with stage timeout.
+
+        Example:
+            worker.pipeline(
+                subject='order.post', queue='worker',
+                stages=['order.validate', ('order.price', 5), 'order.save'])
+        """
+
+        self.config['pipelines'].append({
+            'subject': subject,
+            'queue': queue,
+            'stages': stages
+        })
+
     async def _run_in_loop(self):
         async with self.nats_driver() as nats:
             # Setup worker lifecycle handler
@@ -144,43 +225,325 @@ class Worker(Executor):
                 await nats.subscribe(
                     self.name, cb=self._handle_signal)
 
+            await self.start_locality(nats)
+            await self.start_partitions(nats)
+
             # Register tasks
+            self._subscription_ids = []
+            self._scoped_subjects = []
+            self._partitioned_tasks = {}
+            self._partition_subscription_ids = {}
             for task_spec in self.config['tasks']:
-                if type(task_spec) is str:
-                    _, task_fn = get_module(task_spec['task'])
-                else:
-                    task_fn = task_spec['task']
-
-                # more complicated: self._driver.create_task
-                callback = self._driver.create_task_simple(task_fn)
-
-                subscription_id = await nats.subscribe_async(
-                    task_spec['subject'], queue=task_spec['queue'], cb=callback)
-
-                logging.debug((
-                    'Task is registered '
-                    f'[subscription_id={subscription_id}]'
-                    f'[subject={task_spec["subject"]}]'
-                    f'[queue={task_spec["queue"]}]'
-                    f'[task={task_fn.__name__}]'
-                ))
-
-            # wait for stop signal
-            signal = WORKER_CONTROL_SIGNAL_START
-            while signal != WORKER_CONTROL_SIGNAL_STOP:
-                signal = await self._queue.get()
+                await self._register_task(nats, task_spec)
+
+            for pipeline_spec in self.config['pipelines']:
+                await self._register_pipeline(nats, pipeline_spec)
+
+            monitor = self.start_loop_monitor(self._loop)
+            announcer = self._loop.create_task(self._announce(nats))
+            partitions_joiner = self._loop.create_task(self._join_partitions(nats))
+
+            if self._stop_requested:
+                logging.info('Stop - requested while starting')
+
+            else:
+                self.set_state(EXECUTOR_STATE_READY)
+
+                # wait for stop signal
+                signal = WORKER_CONTROL_SIGNAL_START
+                while signal != WORKER_CONTROL_SIGNAL_STOP:
+                    signal = await self._queue.get()
+
+            announcer.cancel()
+            partitions_joiner.cancel()
+            await self._drain(nats)
+
+            if monitor:
+                monitor.stop()
+
+    @staticmethod
+    def _get_task_fn(task_spec):
+        if type(task_spec['task']) is str:
+            _, task_fn = get_module(task_spec['task'])
+        else:
+            task_fn = task_spec['task']
+
+        return task_fn
+
+    @staticmethod
+    def _compile_schema(task_fn, schema=None):
+        if isinstance(schema, TaskSchema):
+            return schema
+
+        if schema is not None:
+            return TaskSchema.from_dict(schema)
+
+        return TaskSchema.from_function(task_fn)
+
+    def _get_task_schema(self, task_spec, task_fn):
+        schema = task_spec.get('schema')
+        if not isinstance(schema, TaskSchema):
+            schema = task_spec['schema'] = self._compile_schema(task_fn, schema)
+
+        return schema
+
+    async def _register_task(self, nats, task_spec):
+        task_fn = self._get_task_fn(task_spec)
+        schema = self._get_task_schema(task_spec, task_fn)
+
+        # more complicated: self._driver.create_task
+        callback = self._driver.create_task_simple(task_fn, schema=schema)
+
+        subscription_id = await nats.subscribe_async(
+            task_spec['subject'], queue=task_spec['queue'], cb=callback)
+        self._subscription_ids.append(subscription_id)
+
+        logging.debug((
+            'Task is registered '
+            f'[subscription_id={subscription_id}]'
+            f'[subject={task_spec["subject"]}]'
+            f'[queue={task_spec["queue"]}]'
+            f'[task={task_fn.__name__}]'
+        ))
+
+        # pipeline envelopes are accepted only on the internal stage subject,
+        # stages of pipelines registered by any worker
+        subscription_id = await nats.subscribe_async(
+            stage_subject(task_spec['subject']), queue=task_spec['queue'],
+            cb=self._driver.create_task_simple(task_fn, schema=schema, stage=True))
+        self._subscription_ids.append(subscription_id)
+
+        # expose schema for validation at the edge
+        subscription_id = await nats.subscribe(
+            f'{SCHEMA_SUBJECT}.{task_spec["subject"]}', queue=task_spec['queue'],
+            cb=self._driver.create_schema_handler(schema))
+        self._subscription_ids.append(subscription_id)
+
+        # partitions are claimed by `_join_partitions` once peers are known
+        if task_spec.get('partition_key'):
+            self._partitioned_tasks[task_spec['subject']] = (task_spec, callback)
+            self._partition_subscription_ids[task_spec['subject']] = {}
+
+        # node/zone scoped subscriptions refuse messages when overloaded
+        scoped_callback = self._driver.create_task_simple(
+            task_fn, max_pending=self.config['locality_max_pending'], schema=schema)
+
+        for scope in self._locality.scopes:
+            subject = scoped_subject(task_spec['subject'], scope)
+            subscription_id = await nats.subscribe_async(
+                subject, queue=task_spec['queue'], cb=scoped_callback)
+
+            self._subscription_ids.append(subscription_id)
+            self._scoped_subjects.append(subject)
 
-    def _finalize(self):
-        logging.info('Stop - cancel pending eventloop tasks')
-        pending_tasks = asyncio.Task.all_tasks()
-        for task in pending_tasks:
             logging.debug((
-                f'[task={task.__class__.__name__}:{task.__hash__()}]'
+                'Task is registered '
+                f'[subscription_id={subscription_id}]'
+                f'[subject={subject}]'
+                f'[queue={task_spec["queue"]}]'
+                f'[task={task_fn.__name__}]'
             ))
-            with suppress(asyncio.CancelledError):
-                self._loop.run_until_complete(
-                    asyncio.wait_for(task, WORKER_PENDING_AIOTASK_TIMEOUT))
-                logging.debug(f'{task.__hash__()} [done={task.done()}]')
+
+    async def _register_pipeline(self, nats, pipeline_spec):
+        stages = normalize_stages(
+            pipeline_spec['stages'], self.config['pipeline_stage_timeout'])
+        local_tasks = {
+            task_spec['subject']: (self._get_task_fn(task_spec), task_spec.get('schema'))
+            for task_spec in self.config['tasks']
+        }
+
+        callback = self._driver.create_pipeline(stages, local_tasks)
+        subscription_id = await nats.subscribe_async(
+            pipeline_spec['subject'], queue=pipeline_spec['queue'], cb=callback)
+        self._subscription_ids.append(subscription_id)
+
+        # pipeline input is validated by the first stage, if it is local
+        _, first_schema = local_tasks.get(stages[0][0], (None, None))
+        subscription_id = await nats.subscribe(
+            f'{SCHEMA_SUBJECT}.{pipeline_spec["subject"]}', queue=pipeline_spec['queue'],
+            cb=self._driver.create_schema_handler(first_schema))
+        self._subscription_ids.append(subscription_id)
+
+        logging.debug((
+            'Pipeline is registered '
+            f'[subscription_id={subscription_id}]'
+            f'[subject={pipeline_spec["subject"]}]'
+            f'[queue={pipeline_spec["queue"]}]'
+            f'[stages={[subject for subject, _ in stages]}]'
+        ))
+
+    def _partition_announcements(self):
+        if not self._partitions_joined:
+            return []
+
+        return [
+            encode_partition_announcement(
+                self.replica_id, subject,
+                task_spec['partition_key'], self.config['partitions'])
+            for subject, (task_spec, _) in self._partitioned_tasks.items()
+        ]
+
+    def _served_subjects(self):
+        return [
+            spec['subject']
+            for spec in self.config['tasks'] + self.config['pipelines']
+        ]
+
+    async def _announce(self, nats):
+        """Announce served subjects, scoped subjects and partitioned tasks
+        periodically
+        """
+
+        announcements = []
+        if self._served_subjects():
+            announcements.append((
+                REPLICA_SUBJECT_JOIN,
+                encode_announcement(self.replica_id, self._served_subjects())))
+        if self._scoped_subjects:
+            announcements.append((
+                LOCALITY_SUBJECT_JOIN,
+                encode_announcement(self.replica_id, self._scoped_subjects)))
+
+        if not announcements and not self._partitioned_tasks:
+            return
+
+        while True:
+            # partitioned tasks are announced once their partitions are claimed
+            for subject, announcement in announcements + [
+                (PARTITION_SUBJECT_JOIN, announcement)
+                for announcement in self._partition_announcements()
+            ]:
+                await nats.publish(subject, announcement)
+
+            await asyncio.sleep(self.config['heartbeat_interval'])
+
+    async def _join_partitions(self, nats):
+        """Claim partitions after listening to announcements for a TTL
+
+        Claiming right after startup would take every partition until the
+        announcements of the existing owners are heard, so their keys would
+        be shared through the queue group in the meantime.
+        """
+
+        if not self._partitioned_tasks:
+            return
+
+        await asyncio.sleep(self._partitions.ttl)
+
+        for subject, (task_spec, _) in self._partitioned_tasks.items():
+            self._partitions.join(
+                self.replica_id, subject,
+                task_spec['partition_key'], self.config['partitions'])
+            await self._rebalance(nats, subject)
+
+        self._partitions.on_change = self._create_rebalancer(nats)
+        self._partitions_joined = True
+
+    def _create_rebalancer(self, nats):
+        def rebalance(subject):
+            if subject in self._partitioned_tasks:
+                self._loop.create_task(self._rebalance(nats, subject))
+
+        return rebalance
+
+    async def _rebalance(self, nats, subject):
+        """Claim owned partitions and release the others
+
+        Released partitions are unsubscribed after a heartbeat interval, so
+        the new owner subscribes them before they are left unattended.
+        """
+
+        if self.state in (EXECUTOR_STATE_DRAINING, EXECUTOR_STATE_STOPPED):
+            return
+
+        task_spec, callback = self._partitioned_tasks[subject]
+        subscription_ids = self._partition_subscription_ids[subject]
+        owned = self._partitions.owned_partitions(subject, self.replica_id)
+
+        claimed = owned - set(subscription_ids)
+        for partition in claimed:
+            # mark as claimed before awaiting, rebalancing may run concurrently
+            subscription_ids[partition] = None
+
+        for partition in claimed:
+            subscription_ids[partition] = await nats.subscribe_async(
+                partition_subject(subject, partition),
+                queue=task_spec['queue'], cb=callback)
+
+        released = set(subscription_ids) - owned
+        logging.info((
+            'Partitions are rebalanced '
+            f'[subject={subject}][owned={len(owned)}][released={len(released)}]'
+        ))
+
+        if not released:
+            return
+
+        await asyncio.sleep(self.config['heartbeat_interval'])
+
+        owned = self._partitions.owned_partitions(subject, self.replica_id)
+        for partition in released - owned:
+            subscription_id = subscription_ids.pop(partition, None)
+            if subscription_id is not None and self.state == EXECUTOR_STATE_READY:
+                await nats.unsubscribe(subscription_id)
+
+    async def _drain(self, nats):
+        """Stop receiving new messages and wait for in-flight tasks
+
+        Subscriptions are removed first so the queue group routes new
+        messages to the other replicas while pending tasks are finishing.
+        """
+
+        self._drain_deadline = time.monotonic() + self.config['drain_timeout']
+        self.set_state(EXECUTOR_STATE_DRAINING)
+
+        await nats.publish(
+            REPLICA_SUBJECT_LEAVE,
+            encode_announcement(self.replica_id, self._served_subjects()))
+
+        if self._scoped_subjects:
+            await nats.publish(
+                LOCALITY_SUBJECT_LEAVE,
+                encode_announcement(self.replica_id, self._scoped_subjects))
+
+        for announcement in self._partition_announcements():
+            await nats.publish(PARTITION_SUBJECT_LEAVE, announcement)
+
+        subscription_ids = self._subscription_ids + [
+            subscription_id
+            for partitions in self._partition_subscription_ids.values()
+            for subscription_id in partitions.values() if subscription_id is not None
+        ]
+        for subscription_id in subscription_ids:
+            await nats.unsubscribe(subscription_id)
+        logging.info(f'Drain - unsubscribed [subscriptions={len(subscription_ids)}]')
+
+        await self._driver.wait_for_pending(self._drain_remains())
+
+    def _drain_remains(self):
+        if self._drain_deadline is None:
+            return self.config['drain_timeout']
+
+        return max(self._drain_deadline - time.monotonic(), 0)
+
+    def _finalize(self):
+        pending_tasks = [
+            task for task in asyncio.all_tasks(self._loop) if not task.done()]
+        logging.info(f'Stop - wait pending eventloop tasks [pending={len(pending_tasks)}]')
+
+        if pending_tasks:
+            _, pending_tasks = self._loop.run_until_complete(
+                asyncio.wait(pending_tasks, timeout=self._drain_remains()))
+
+        if pending_tasks:
+            logging.warning(f'Stop - cancel pending eventloop tasks [pending={len(pending_tasks)}]')
+            for task in pending_tasks:
+                task.cancel()
+
+            self._loop.run_until_complete(
+                asyncio.gather(*pending_tasks, return_exceptions=True))
+
+        self.set_state(EXECUTOR_STATE_STOPPED)
 
         logging.info('Stop - close eventloop')
         self._loop.close()
@@ -191,26 +554,54 @@ class Worker(Executor):
             self._loop.run_until_complete(self._run_in_loop())
 
         except KeyboardInterrupt:
-            logging.debug(f'Stop - send stop message to worker')
-            self.stop()
+            logging.debug('Stop - interrupted')
 
         finally:
             self._finalize()
 
         logging.info('Bye')
 
-    async def async_request(self, name, payload):
+    async def async_request(self, name, payload, key=None):
+        # reuse connection (and its reply inbox) of the running worker
+        if self._driver.is_connected:
+            return await self.route_request(
+                self._partitions.resolve(name, key), payload, timeout=WORKER_TASK_TIMEOUT)
+
         async with self.nats_driver() as nats:
-            res = await nats.request(name, payload, timeout=WORKER_TASK_TIMEOUT)
+            if key is not None:
+                await self._wait_for_partitions(nats, name)
+
+            res = await self.route_request(
+                self._partitions.resolve(name, key), payload, timeout=WORKER_TASK_TIMEOUT)
             return res
 
+    async def _wait_for_partitions(self, nats, subject):
+        """Listen to partition announcements until members of the subject
+        are known, up to a heartbeat interval
+
+        Subject which is still not partitioned is requested through the
+        global queue group.
+        """
+
+        await self.start_partitions(nats)
+
+        deadline = time.monotonic() + self.config['heartbeat_interval']
+        while not self._partitions.is_partitioned(subject) and time.monotonic() < deadline:
+            await asyncio.sleep(PARTITION_POLL_INTERVAL)
+
+        if not self._partitions.is_partitioned(subject):
+            logging.warning(f'Partition members are unknown, key is ignored [subject={subject}]')
+
     async def async_publish(self, name, payload):
+        if self._driver.is_connected:
+            return await self._driver.nats.publish(name, payload)
+
         async with self.nats_driver() as nats:
             await nats.publish(name, payload)
 
-    def request(self, name, payload):
+    def request(self, name, payload, key=None):
         response = self._loop.run_until_complete(
-            self.async_request(name, payload))
+            self.async_request(name, payload, key=key))
         return response
 
     def publish(self, name, payload):